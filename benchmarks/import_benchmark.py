@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''Import-time benchmark for the singer package.
+
+Times `import singer` in fresh interpreters and checks that it does not
+pull in the dependencies singer only needs on first use.
+
+    python benchmarks/import_benchmark.py
+    python benchmarks/import_benchmark.py --max-ms 100
+
+Exits non-zero if a deferred module was imported or if the median import
+time is over --max-ms.
+'''
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+DEFAULT_RUNS = 10
+
+# Modules `import singer` must leave for first use
+DEFERRED_MODULES = [
+    'argparse',
+    'asyncio',
+    'backoff',
+    'dateutil.parser',
+    'jsonschema',
+    'multiprocessing',
+    'numpy',
+    'requests',
+    'simplejson',
+    'singer.catalog',
+    'singer.messages',
+]
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import singer
+elapsed = time.perf_counter() - start
+print(json.dumps({"ms": elapsed * 1000, "modules": sorted(sys.modules)}))
+'''
+
+
+def measure():
+    output = subprocess.run([sys.executable, '-c', PROBE], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                        help='Interpreters to time; the median is reported')
+    parser.add_argument('--max-ms', type=float,
+                        help='Fail if the median import time is over this')
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    times = [result['ms'] for result in results]
+    median = statistics.median(times)
+    print(f"import singer: median {median:.1f} ms, min {min(times):.1f} ms, "
+          f"max {max(times):.1f} ms over {args.runs} runs")
+
+    failed = False
+    imported = [name for name in DEFERRED_MODULES if name in results[0]['modules']]
+    if imported:
+        print(f"Imported eagerly: {', '.join(imported)}")
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"Slower than {args.max_ms} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''Microbenchmarks for singer.transform.
+
+Runs singer.transform over batches of generated records for a set of
+representative schemas, with and without metadata filtering, and reports
+records per second, speed relative to a reference workload, the peak
+memory allocated while transforming a batch and the number of memory
+blocks still allocated afterwards, with the results kept, from tracemalloc
+snapshots.
+
+    python benchmarks/transform_benchmark.py
+    python benchmarks/transform_benchmark.py --save benchmarks/baseline.json
+    python benchmarks/transform_benchmark.py --compare benchmarks/baseline.json
+
+Records per second depend on the machine, so each case also times the
+reference workload, deep copies of the same records, and baselines are
+compared by speed relative to it. Caches are cleared before each run, so
+every run starts cold like a sync. Timings still vary between runs, so
+--compare only marks the cases that changed by more than --threshold.
+'''
+
+import argparse
+import copy
+import decimal
+import json
+import random
+import time
+import tracemalloc
+
+import singer.metadata
+from singer.schema_generation import generate_schema
+from singer.transform import (DEFAULT_DATETIME_CACHE_SIZE, _TRANSFORMERS, set_datetime_cache_size,
+                              transform)
+
+DEFAULT_RECORDS = 1000
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.25
+
+
+def flat_wide(rng):
+    properties = {}
+    for i in range(20):
+        properties[f"int_{i}"] = {"type": ["null", "integer"]}
+        properties[f"num_{i}"] = {"type": ["null", "number"]}
+        properties[f"str_{i}"] = {"type": ["null", "string"]}
+    schema = {"type": ["null", "object"], "properties": properties}
+
+    def record():
+        result = {}
+        for i in range(20):
+            result[f"int_{i}"] = rng.choice([rng.randint(0, 10**6), str(rng.randint(0, 10**6)), None])
+            result[f"num_{i}"] = rng.choice([rng.random() * 1000, str(rng.random()), None])
+            result[f"str_{i}"] = rng.choice([f"value {rng.randint(0, 100)}", None])
+        return result
+
+    return schema, record
+
+
+def nested(rng):
+    leaf = {"type": "object",
+            "properties": {"id": {"type": "integer"},
+                           "name": {"type": ["null", "string"]},
+                           "tags": {"type": "array", "items": {"type": "string"}}}}
+    schema = {"type": "object",
+              "properties": {"id": {"type": "integer"},
+                             "a": {"type": "object",
+                                   "properties": {"b": {"type": "object",
+                                                        "properties": {"c": leaf}},
+                                                  "items": {"type": "array", "items": leaf}}}}}
+
+    def make_leaf():
+        return {"id": str(rng.randint(0, 1000)), "name": "leaf",
+                "tags": [str(i) for i in range(rng.randint(0, 5))]}
+
+    def record():
+        return {"id": rng.randint(0, 10**6),
+                "a": {"b": {"c": make_leaf()},
+                      "items": [make_leaf() for _ in range(rng.randint(1, 8))]}}
+
+    return schema, record
+
+
+def any_of(rng):
+    def record():
+        return {"id": rng.choice([rng.randint(0, 1000), str(rng.randint(0, 1000))]),
+                "value": rng.choice([rng.randint(0, 1000), rng.random(), "text", None, True]),
+                "nested": {"x": rng.choice([1, "1", 1.5, None]),
+                           "y": [rng.choice([1, "a", None]) for _ in range(3)]}}
+
+    samples = [record() for _ in range(200)]
+    return generate_schema(samples), record
+
+
+def pattern_properties(rng):
+    schema = {"type": "object",
+              "properties": {"id": {"type": "integer"},
+                             "counts": {"type": "object",
+                                        "patternProperties": {
+                                            "^count_": {"type": "integer"},
+                                            "^label_": {"type": "string"}}}}}
+
+    def record():
+        counts = {}
+        for i in range(20):
+            counts[f"count_{i}"] = str(rng.randint(0, 100))
+            counts[f"label_{i}"] = rng.randint(0, 100)
+        return {"id": rng.randint(0, 1000), "counts": counts}
+
+    return schema, record
+
+
+def date_times(rng):
+    properties = {f"at_{i}": {"type": ["null", "string"], "format": "date-time"}
+                  for i in range(10)}
+    schema = {"type": "object", "properties": properties}
+
+    def record():
+        return {f"at_{i}": rng.choice([
+            f"2017-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T"
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00Z",
+            f"2020-01-{rng.randint(1, 28):02d}",
+            "2019-06-01T00:00:00.000000Z",
+            None]) for i in range(10)}
+
+    return schema, record
+
+
+def decimals(rng):
+    properties = {f"amount_{i}": {"type": ["null", "string"], "format": "singer.decimal"}
+                  for i in range(12)}
+    schema = {"type": "object", "properties": properties}
+
+    def record():
+        return {f"amount_{i}": rng.choice([
+            f"{rng.randint(0, 10**6)}.{rng.randint(0, 99):02d}",
+            rng.randint(0, 10**6),
+            rng.random() * 100,
+            decimal.Decimal(f"{rng.randint(0, 1000)}.5"),
+            None]) for i in range(12)}
+
+    return schema, record
+
+
+CASES = {
+    'flat_wide': flat_wide,
+    'nested': nested,
+    'any_of': any_of,
+    'pattern_properties': pattern_properties,
+    'date_times': date_times,
+    'decimals': decimals,
+}
+
+
+def deselect_half(record):
+    '''Metadata deselecting every other leaf field of record, at every
+    level, so that filtering walks nested objects too.'''
+    leaves = []
+
+    def walk(value, breadcrumb):
+        if isinstance(value, dict) and value:
+            for key in sorted(value):
+                walk(value[key], breadcrumb + ('properties', key))
+        elif isinstance(value, list) and value and isinstance(value[0], dict):
+            walk(value[0], breadcrumb + ('items',))
+        else:
+            leaves.append(breadcrumb)
+
+    walk(record, ())
+    mdata = singer.metadata.new()
+    for breadcrumb in leaves[::2]:
+        mdata = singer.metadata.write(mdata, breadcrumb, 'selected', False)
+    return mdata
+
+
+def reset_caches():
+    '''Forget what transform() learned from earlier runs, so that every run
+    starts cold, as a sync does.'''
+    _TRANSFORMERS.cache = {}
+    set_datetime_cache_size(DEFAULT_DATETIME_CACHE_SIZE)
+
+
+def time_batch(records, func):
+    '''Return the seconds func takes over a copy of records.'''
+    batch = copy.deepcopy(records)
+    reset_caches()
+    start = time.perf_counter()
+    for record in batch:
+        func(record)
+    return time.perf_counter() - start
+
+
+def run_case(schema, records, metadata, repeat):
+    # The reference is timed next to each run so that both see the machine
+    # in the same state
+    best = reference = None
+    for _ in range(repeat):
+        elapsed = time_batch(records, copy.deepcopy)
+        reference = elapsed if reference is None else min(reference, elapsed)
+        elapsed = time_batch(records, lambda record: transform(record, schema, metadata=metadata))
+        best = elapsed if best is None else min(best, elapsed)
+
+    batch = copy.deepcopy(records)
+    reset_caches()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = [transform(record, schema, metadata=metadata) for record in batch]
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Leave out the snapshots themselves
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    blocks = sum(stat.count_diff for stat in after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), 'filename'))
+    del results
+
+    return {'records_per_second': round(len(records) / best),
+            'relative_speed': round(reference / best, 4),
+            'peak_kib': round(peak / 1024, 1),
+            'blocks': blocks}
+
+
+def run(record_count, repeat):
+    results = {}
+    for name, case in CASES.items():
+        rng = random.Random(name)
+        schema, make_record = case(rng)
+        records = [make_record() for _ in range(record_count)]
+        results[name] = run_case(schema, records, None, repeat)
+        results[name + '+metadata'] = run_case(schema, records, deselect_half(records[0]),
+                                               repeat)
+    return results
+
+
+def report(results, baseline, threshold):
+    '''Print results, compared with baseline if given, marking the cases
+    whose relative speed changed by more than threshold.'''
+    print(f"{'case':<30}{'records/s':>12}{'relative':>10}{'peak KiB':>10}{'blocks':>8}"
+          f"{'baseline':>10}{'change':>9}")
+    for name, result in results.items():
+        line = (f"{name:<30}{result['records_per_second']:>12}{result['relative_speed']:>10.3f}"
+                f"{result['peak_kib']:>10}{result['blocks']:>8}")
+        previous = (baseline or {}).get(name)
+        if previous:
+            change = result['relative_speed'] / previous['relative_speed'] - 1
+            line += f"{previous['relative_speed']:>10.3f}{change:>+9.0%}"
+            if abs(change) > threshold:
+                line += "  slower" if change < 0 else "  faster"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=DEFAULT_RECORDS,
+                        help='Records per case')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Timed runs per case; the fastest is reported')
+    parser.add_argument('--save', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Smallest change in relative speed that is marked')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fil:
+            baseline = json.load(fil)
+
+    results = run(args.records, args.repeat)
+    report(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, 'w', encoding="utf-8") as fil:
+            json.dump(results, fil, indent=2, sort_keys=True)
+            fil.write('\n')
+
+
+if __name__ == '__main__':
+    main()
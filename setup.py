@@ -18,12 +18,16 @@ setup(name="singer-python",
           'ciso8601>=2.3.1,==2.*',
       ],
       extras_require={
+          'http': [
+              'requests>=2.20,==2.*',
+          ],
           'dev': [
               'pylint',
               'ipython',
               'ipdb',
               'nose',
-              'singer-tools'
+              'singer-tools',
+              'requests',
           ]
       },
       packages=find_packages(),
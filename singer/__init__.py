@@ -1,5 +1,9 @@
+import importlib
+import types
+
 from singer import utils
 from singer.utils import (
+    batches,
     chunk,
     load_json,
     parse_args,
@@ -29,62 +33,103 @@ from singer.metrics import (
     record_counter,
 )
 
-from singer.messages import (
-    ActivateVersionMessage,
-    Message,
-    RecordMessage,
-    SchemaMessage,
-    StateMessage,
-    format_message,
-    parse_message,
-    write_message,
-    write_record,
-    write_records,
-    write_schema,
-    write_state,
-    write_version,
-)
-
+# singer.transform is imported eagerly because the transform function shares
+# its name: importing the submodule later would replace singer.transform
+# with the module.
 from singer.transform import (
     NO_INTEGER_DATETIME_PARSING,
     UNIX_SECONDS_INTEGER_DATETIME_PARSING,
     UNIX_MILLISECONDS_INTEGER_DATETIME_PARSING,
+    FieldHook,
     Transformer,
     transform,
     _transform_datetime,
     resolve_schema_references
 )
 
-from singer.catalog import (
-    Catalog,
-    CatalogEntry
-)
-from singer.schema import Schema
 
-from singer.state import (
-    set_bookmark,
+# The rest of the public API is imported the first time it is used, so that
+# `import singer` does not pay for simplejson, asyncio and friends in tap
+# invocations that never touch them.
+_LAZY_ATTRIBUTES = {
+    'FileTokenBucket': ('singer.limiter', 'FileTokenBucket'),
+    'TokenBucket': ('singer.limiter', 'TokenBucket'),
+
+    'ActivateVersionMessage': ('singer.messages', 'ActivateVersionMessage'),
+    'Message': ('singer.messages', 'Message'),
+    'RecordMessage': ('singer.messages', 'RecordMessage'),
+    'SchemaMessage': ('singer.messages', 'SchemaMessage'),
+    'StateMessage': ('singer.messages', 'StateMessage'),
+    'format_message': ('singer.messages', 'format_message'),
+    'parse_message': ('singer.messages', 'parse_message'),
+    'write_message': ('singer.messages', 'write_message'),
+    'write_record': ('singer.messages', 'write_record'),
+    'write_records': ('singer.messages', 'write_records'),
+    'write_schema': ('singer.messages', 'write_schema'),
+    'write_state': ('singer.messages', 'write_state'),
+    'write_version': ('singer.messages', 'write_version'),
+
+    'TransformPool': ('singer.transform_pool', 'TransformPool'),
+
+    'prefetch_pages': ('singer.pagination', 'prefetch_pages'),
+    'prefetch_records': ('singer.pagination', 'prefetch_records'),
+
+    'Catalog': ('singer.catalog', 'Catalog'),
+    'CatalogEntry': ('singer.catalog', 'CatalogEntry'),
+    'Schema': ('singer.schema', 'Schema'),
+
+    'set_bookmark': ('singer.state', 'set_bookmark'),
     # for backwards compatibility, use set_bookmark instead
-    set_bookmark as write_bookmark,
-    get_bookmark,
-    clear_bookmark,
-    reset_stream,
-    set_offset,
-    clear_offset,
-    get_offset,
-    set_currently_syncing,
-    get_currently_syncing,
-    set_version,
-    clear_version,
-    get_version,
-)
+    'write_bookmark': ('singer.state', 'set_bookmark'),
+    'get_bookmark': ('singer.state', 'get_bookmark'),
+    'clear_bookmark': ('singer.state', 'clear_bookmark'),
+    'reset_stream': ('singer.state', 'reset_stream'),
+    'set_offset': ('singer.state', 'set_offset'),
+    'clear_offset': ('singer.state', 'clear_offset'),
+    'get_offset': ('singer.state', 'get_offset'),
+    'set_currently_syncing': ('singer.state', 'set_currently_syncing'),
+    'get_currently_syncing': ('singer.state', 'get_currently_syncing'),
+    'set_version': ('singer.state', 'set_version'),
+    'clear_version': ('singer.state', 'clear_version'),
+    'get_version': ('singer.state', 'get_version'),
+
+    'SingerConfigurationError': ('singer.exceptions', 'SingerConfigurationError'),
+    'SingerDiscoveryError': ('singer.exceptions', 'SingerDiscoveryError'),
+    'SingerError': ('singer.exceptions', 'SingerError'),
+    'SingerRetryableRequestError': ('singer.exceptions', 'SingerRetryableRequestError'),
+    'SingerSyncError': ('singer.exceptions', 'SingerSyncError'),
+}
+
+# Submodules that `import singer` used to import, and so could be used as
+# attributes without importing them first.
+_LAZY_SUBMODULES = {'bookmarks', 'catalog', 'exceptions', 'limiter', 'messages',
+                    'pagination', 'requests', 'schema', 'state'}
+
+
+# Names `from singer import *` has always provided: the functions and
+# classes above, and the submodules `import singer` used to import
+__all__ = sorted([name for name, value in globals().items()
+                  if not name.startswith('_') and not isinstance(value, types.ModuleType)]
+                 + list(_LAZY_ATTRIBUTES)
+                 + ['bookmarks', 'catalog', 'exceptions', 'logger', 'messages', 'metadata',
+                    'metrics', 'schema', 'state', 'utils'])
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module, attribute = _LAZY_ATTRIBUTES[name]
+        value = getattr(importlib.import_module(module), attribute)
+    elif name in _LAZY_SUBMODULES:
+        value = importlib.import_module(f"{__name__}.{name}")
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | _LAZY_SUBMODULES)
 
-from singer.exceptions import (
-    SingerConfigurationError,
-    SingerDiscoveryError,
-    SingerError,
-    SingerRetryableRequestError,
-    SingerSyncError,
-)
 
 if __name__ == "__main__":
     import doctest
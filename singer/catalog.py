@@ -9,6 +9,110 @@ from .schema import Schema
 
 LOGGER = get_logger()
 
+# Characters read from a catalog at a time when streaming its entries
+STREAM_READ_SIZE = 64 * 1024
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]}'
+
+
+class _JSONReader():
+    '''Decodes a JSON document one value at a time from a file, holding only
+    the text of the value being decoded in memory.'''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        if self.eof:
+            return False
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.fp.read(max(size, STREAM_READ_SIZE))
+        self.eof = not data
+        self.buffer += data
+        return not self.eof
+
+    def peek(self):
+        '''Skip whitespace and return the next character, or '' at the end.'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill(STREAM_READ_SIZE):
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.buffer, self.pos)
+        self.pos += 1
+
+    def value(self):
+        '''Decode the next value, reading more of the file until it is whole.'''
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, self.pos)
+                # A number is only whole once we can see what follows it:
+                # "1." or "2e" at the end of the buffer decode as 1 and 2.
+                if self.eof or (end < len(self.buffer) and (
+                        not isinstance(value, (int, float))
+                        or self.buffer[end] in _DELIMITERS)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow reads geometrically so a large value is not re-decoded
+            # once per STREAM_READ_SIZE.
+            self._fill(len(self.buffer) - self.pos)
+
+
+def _iter_array_items(fp, key):
+    '''Yield the items of the array under the top-level key of the JSON
+    object in fp, one at a time.'''
+    reader = _JSONReader(fp)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key:
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ']':
+                        reader.pos += 1
+                        break
+                    reader.expect(',')
+        else:
+            reader.value()
+        if reader.peek() == '}':
+            return
+        reader.expect(',')
+
+
+def iter_streams(filename):
+    '''Yield the raw dict of each entry in the streams array of the catalog
+    file, without reading the whole file into memory.'''
+    with open(filename, encoding="utf-8") as fp:
+        yield from _iter_array_items(fp, 'streams')
+
+
+def is_selected_stream(stream):
+    '''Returns True if the raw catalog stream dict is selected, the same
+    way CatalogEntry.is_selected does.'''
+    mdata = metadata_module.to_map(stream.get('metadata') or [])
+    return bool((stream.get('schema') or {}).get('selected')
+                or metadata_module.get(mdata, (), 'selected'))
+
 
 def write_catalog(catalog):
     # If the catalog has no streams, log a warning
@@ -80,6 +184,53 @@ class CatalogEntry():
         return result
 
 
+class LazyCatalogEntry(CatalogEntry):
+    '''A CatalogEntry that builds its Schema from the raw schema dict the
+    first time the schema is used, rather than when the catalog is loaded.'''
+
+    def __init__(self, raw_schema=None, **kwargs):
+        super().__init__(**kwargs)
+        self._raw_schema = raw_schema
+
+    @property
+    def schema(self):
+        if self._raw_schema is not None:
+            self._schema = Schema.from_dict(self._raw_schema)
+            self._raw_schema = None
+        return self._schema
+
+    @schema.setter
+    def schema(self, value):
+        self._schema = value
+        self._raw_schema = None
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def __eq__(self, other):
+        return self.to_dict() == other.to_dict()
+
+    def is_selected(self):
+        if self._raw_schema is None:
+            return super().is_selected()
+        return is_selected_stream({'schema': self._raw_schema, 'metadata': self.metadata})
+
+
+def _entry_kwargs(stream):
+    return {
+        'tap_stream_id': stream.get('tap_stream_id'),
+        'stream': stream.get('stream'),
+        'replication_key': stream.get('replication_key'),
+        'key_properties': stream.get('key_properties'),
+        'database': stream.get('database_name'),
+        'table': stream.get('table_name'),
+        'is_view': stream.get('is_view'),
+        'stream_alias': stream.get('stream_alias'),
+        'metadata': stream.get('metadata'),
+        'replication_method': stream.get('replication_method'),
+    }
+
+
 class Catalog():
 
     def __init__(self, streams):
@@ -92,12 +243,24 @@ class Catalog():
         return self.__dict__ == other.__dict__
 
     @classmethod
-    def load(cls, filename):
-        with open(filename, encoding="utf-8") as fp:
-            return Catalog.from_dict(json.load(fp))
+    def load(cls, filename, lazy=False, tap_stream_ids=None, selected_only=False):
+        '''Load a catalog file. Passing tap_stream_ids or selected_only loads
+        just those streams, reading the file one stream at a time so that
+        memory is only spent on the streams kept.'''
+        if tap_stream_ids is None and not selected_only:
+            with open(filename, encoding="utf-8") as fp:
+                return Catalog.from_dict(json.load(fp), lazy=lazy)
+
+        streams = (stream for stream in iter_streams(filename)
+                   if (tap_stream_ids is None or stream.get('tap_stream_id') in tap_stream_ids)
+                   and (not selected_only or is_selected_stream(stream)))
+        return Catalog.from_dict({'streams': streams}, lazy=lazy)
 
     @classmethod
-    def from_dict(cls, data):
+    def from_dict(cls, data, lazy=False):
+        '''Build a Catalog from its JSON structure. With lazy=True each stream
+        is a LazyCatalogEntry, so only the schemas of streams that are used
+        get parsed.'''
         # TODO: We may want to store streams as a dict where the key is a
         # tap_stream_id and the value is a CatalogEntry. This will allow
         # faster lookup based on tap_stream_id. This would be a breaking
@@ -105,18 +268,11 @@ class Catalog():
         # directly.
         streams = []
         for stream in data['streams']:
-            entry = CatalogEntry()
-            entry.tap_stream_id = stream.get('tap_stream_id')
-            entry.stream = stream.get('stream')
-            entry.replication_key = stream.get('replication_key')
-            entry.key_properties = stream.get('key_properties')
-            entry.database = stream.get('database_name')
-            entry.table = stream.get('table_name')
-            entry.schema = Schema.from_dict(stream.get('schema'))
-            entry.is_view = stream.get('is_view')
-            entry.stream_alias = stream.get('stream_alias')
-            entry.metadata = stream.get('metadata')
-            entry.replication_method = stream.get('replication_method')
+            if lazy:
+                entry = LazyCatalogEntry(raw_schema=stream.get('schema'), **_entry_kwargs(stream))
+            else:
+                entry = CatalogEntry(schema=Schema.from_dict(stream.get('schema')),
+                                     **_entry_kwargs(stream))
             streams.append(entry)
         return Catalog(streams)
 
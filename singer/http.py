@@ -0,0 +1,110 @@
+'''A pooled HTTP client for taps.
+
+Client keeps one requests.Session with keep-alive connections, so repeated
+requests to an API reuse their TCP and TLS connections. Every request
+
+  * waits for a token from an optional TokenBucket,
+  * is timed with http_request_timer, tagged with its status code,
+  * raises SingerRetryableRequestError for 429 and 5xx responses, and
+  * is retried by utils.adaptive_backoff on those errors and on connection
+    failures and timeouts, honouring Retry-After.
+
+    with singer.http.Client("https://api.example.com", limiter=TokenBucket(10)) as client:
+        users = client.get("/users", endpoint="users", params={"page": 1}).json()
+
+Requires the requests package.
+'''
+
+from urllib.parse import urljoin
+
+try:
+    import requests
+    import requests.adapters
+except ImportError:
+    requests = None
+
+from singer import metrics
+from singer.exceptions import SingerRetryableRequestError
+from singer.utils import adaptive_backoff
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 300
+DEFAULT_MAX_TRIES = 5
+
+
+def _retryable_exceptions():
+    return (SingerRetryableRequestError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout)
+
+
+class Client():
+    '''Sends requests over a pooled session with rate limiting, retries and
+    request timing.
+
+    base_url is joined with relative request urls. pool_size is how many
+    connections are kept open to each host; size it to the number of
+    threads making requests through the client.
+    '''
+
+    def __init__(self, base_url=None, *, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 limiter=None, max_tries=DEFAULT_MAX_TRIES, headers=None):
+        if requests is None:
+            raise RuntimeError("singer.http requires the requests package")
+        self.base_url = base_url
+        self.timeout = timeout
+        self.limiter = limiter
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self._send_with_retries = adaptive_backoff(
+            _retryable_exceptions(), limiter=limiter, max_tries=max_tries)(self._send)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Close the pooled connections.'''
+        self.session.close()
+
+    def _send(self, method, url, endpoint, kwargs):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+        with metrics.http_request_timer(endpoint) as timer:
+            response = self.session.request(method, url, **kwargs)
+            timer.tags[metrics.Tag.http_status_code] = response.status_code
+            if not response.ok:
+                timer.tags[metrics.Tag.status] = metrics.Status.failed
+
+        if response.status_code == 429 or response.status_code >= 500:
+            error = SingerRetryableRequestError(
+                f"{method} {url} returned {response.status_code}: {response.reason}")
+            error.response = response
+            raise error
+        response.raise_for_status()
+        return response
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        '''Send a request and return the response. Raises
+        requests.HTTPError for 4xx responses other than 429, and
+        SingerRetryableRequestError once retries of a 429 or 5xx run out.'''
+        if self.base_url:
+            url = urljoin(self.base_url, url)
+        kwargs.setdefault('timeout', self.timeout)
+        return self._send_with_retries(method, url, endpoint, kwargs)
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request('POST', url, endpoint=endpoint, **kwargs)
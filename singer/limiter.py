@@ -0,0 +1,305 @@
+'''Token-bucket rate limiting.
+
+A TokenBucket admits `rate` calls every `per` seconds, with bursts of up to
+`capacity` calls. It is safe to share between threads and between several
+functions that draw on the same API quota:
+
+    bucket = TokenBucket(100, per=60)
+
+    @bucket
+    def get_users(...):
+        ...
+
+    @bucket
+    def get_orders(...):
+        ...
+
+Callers reserve tokens under a lock and sleep outside it. A caller that
+finds the bucket empty takes its token on credit and sleeps only until that
+token would have been refilled, so concurrent callers queue up behind each
+other exactly at the refill rate instead of all waking up at once.
+
+Coroutine functions can be decorated too. They wait with asyncio.sleep, so
+the event loop keeps running other tasks, and may share a bucket with
+threads:
+
+    @bucket
+    async def get_invoices(session, page):
+        ...
+
+FileTokenBucket keeps its tokens in a locked file instead, so several tap
+processes on one host can split a single API quota. SlidingWindow is
+stricter than a bucket: it never lets more than `limit` calls start within
+any `every` seconds, however the calls are spread out.
+'''
+
+import collections
+import contextlib
+import functools
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from singer import metrics
+from singer.logger import get_logger
+
+LOGGER = get_logger()
+
+# inspect.CO_COROUTINE, spelled out so that decorating a function does not
+# import inspect or asyncio
+_CO_COROUTINE = 0x80
+
+# A throttled bucket cuts its rate by this factor, down to no less than
+# MIN_RATE_FRACTION of the rate it was created with, and each successful
+# call then wins back RECOVERY_STEP of that rate.
+THROTTLE_FACTOR = 0.5
+MIN_RATE_FRACTION = 0.05
+RECOVERY_STEP = 0.01
+
+
+def _is_coroutine_function(func):
+    while isinstance(func, functools.partial):
+        func = func.func
+    code = getattr(func, '__code__', None)
+    return code is not None and bool(code.co_flags & _CO_COROUTINE)
+
+
+class _Limiter():
+    '''Waiting and decorating for limiters, which implement reserve().'''
+
+    def __init__(self, clock, sleep):
+        self.clock = clock
+        self.sleep = sleep
+
+    def reserve(self, tokens=1):
+        '''Take tokens and return how many seconds the caller must wait
+        before using them.'''
+        raise NotImplementedError
+
+    def throttle(self, wait=0.0):
+        '''Called after the server throttled a request. Limiters that can't
+        adapt their rate ignore it.'''
+
+    def recover(self):
+        '''Called after a successful request. Limiters that can't adapt
+        their rate ignore it.'''
+
+    def acquire(self, tokens=1):
+        '''Block until tokens are available. Returns the seconds waited.'''
+        wait = self.reserve(tokens)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=1):
+        '''Wait without blocking the event loop until tokens are available.
+        Returns the seconds waited.'''
+        import asyncio  # pylint: disable=import-outside-toplevel
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def __call__(self, func):
+        '''Decorate func so every call acquires one token first.'''
+        if _is_coroutine_function(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                await self.acquire_async()
+                return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.acquire()
+            return func(*args, **kwargs)
+        return wrapper
+
+
+class TokenBucket(_Limiter): # pylint: disable=too-many-instance-attributes
+    '''Thread-safe token bucket admitting `rate` tokens every `per` seconds.
+
+    capacity is the largest burst the bucket allows and defaults to rate.
+    The bucket starts full. Time spent waiting for tokens is tallied in
+    `waits` and `wait_seconds` and can be emitted with log_metrics().
+    '''
+
+    def __init__(self, rate, per=1.0, capacity=None, *, name=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0 or per <= 0:
+            raise ValueError("rate and per must be positive")
+        self.rate = rate
+        self.max_rate = rate
+        self.per = per
+        self.capacity = rate if capacity is None else capacity
+        if self.capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.name = name
+        super().__init__(clock, sleep)
+
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+
+    @property
+    def fill_rate(self):
+        '''Tokens added to the bucket per second.'''
+        return self.rate / self.per
+
+    @contextlib.contextmanager
+    def _state(self):
+        '''Hold the bucket exclusively while its token count is updated.'''
+        with self._lock:
+            yield
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.fill_rate)
+            self._updated = now
+
+    def reserve(self, tokens=1):
+        '''Take tokens from the bucket, going into debt if it is short, and
+        return how many seconds the caller must wait before using them.'''
+        if tokens > self.capacity:
+            raise ValueError(f"Cannot acquire {tokens} tokens from a bucket "
+                             f"with capacity {self.capacity}")
+        with self._state():
+            self._refill(self.clock())
+            self._tokens -= tokens
+            self.acquired += tokens
+            if self._tokens >= 0:
+                return 0.0
+            wait = -self._tokens / self.fill_rate
+            self.waits += 1
+            self.wait_seconds += wait
+            return wait
+
+    def try_acquire(self, tokens=1):
+        '''Take tokens only if they are available right now.'''
+        with self._state():
+            self._refill(self.clock())
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            self.acquired += tokens
+            return True
+
+    def available(self):
+        '''Tokens that could be acquired right now without waiting.'''
+        with self._state():
+            self._refill(self.clock())
+            return max(0.0, self._tokens)
+
+    def throttle(self, wait=0.0):
+        '''Slow down after the server throttled a request: cut the rate by
+        THROTTLE_FACTOR and hold every caller back for wait seconds.'''
+        with self._state():
+            self._refill(self.clock())
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate * THROTTLE_FACTOR)
+            if wait > 0:
+                self._tokens = min(self._tokens, 1 - wait * self.fill_rate)
+
+    def recover(self):
+        '''Raise a throttled rate back towards the rate the bucket was created
+        with after a successful call.'''
+        if self.rate < self.max_rate:
+            with self._state():
+                self._refill(self.clock())
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_STEP)
+
+    def log_metrics(self):
+        '''Emit a rate_limit_wait METRIC with the time spent waiting so far.'''
+        tags = {'acquired': self.acquired, 'waits': self.waits}
+        if self.name:
+            tags[metrics.Tag.endpoint] = self.name
+        metrics.log(LOGGER, metrics.Point('timer', metrics.Metric.rate_limit_wait,
+                                          self.wait_seconds, tags))
+
+
+class SlidingWindow(_Limiter):
+    '''Thread-safe limiter letting at most `limit` calls start in any
+    `every` seconds.
+
+    A TokenBucket refills continuously, so right after a full burst it
+    already admits more calls; a window holds each call until the call
+    `limit` places before it is `every` seconds old. ratelimit() uses one.
+    '''
+
+    def __init__(self, limit, every, *, clock=time.monotonic, sleep=time.sleep):
+        if limit < 1 or every <= 0:
+            raise ValueError("limit must be at least 1 and every positive")
+        super().__init__(clock, sleep)
+        self.limit = limit
+        self.every = every
+
+        self._lock = threading.Lock()
+        # Start times of the last limit calls, oldest first
+        self._starts = collections.deque()
+
+    def reserve(self, tokens=1):
+        '''Claim the next start times for tokens calls and return how many
+        seconds the caller must wait before making them.'''
+        if tokens > self.limit:
+            raise ValueError(f"Cannot acquire {tokens} tokens from a window "
+                             f"with limit {self.limit}")
+        with self._lock:
+            now = self.clock()
+            start = now
+            while len(self._starts) + tokens > self.limit:
+                start = max(start, self._starts.popleft() + self.every)
+            self._starts.extend([start] * tokens)
+            return start - now
+
+
+# Token count and time of the last refill, as stored in a FileTokenBucket
+_FILE_STATE = struct.Struct('<dd')
+
+
+class FileTokenBucket(TokenBucket):
+    '''A TokenBucket whose tokens live in a file, so that every process on
+    the host that opens a bucket on the same path draws from one budget.
+
+    The file is locked with flock while tokens are taken and is created
+    full if it does not exist. Every process must use the same rate, per
+    and capacity. Wait metrics, and any rate change made by throttle(), are
+    per process; the wait imposed by throttle() is shared.
+
+        bucket = FileTokenBucket('/tmp/my-api.bucket', 100, per=60)
+    '''
+
+    def __init__(self, path, rate, per=1.0, capacity=None, *, name=None,
+                 clock=time.time, sleep=time.sleep):
+        if fcntl is None:
+            raise RuntimeError("FileTokenBucket requires fcntl file locking")
+        self.path = path
+        super().__init__(rate, per=per, capacity=capacity, name=name,
+                         clock=clock, sleep=sleep)
+
+    @contextlib.contextmanager
+    def _state(self):
+        # The file is opened for each update because flock locks belong to
+        # the open file, which a forked child would otherwise share.
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = os.pread(fd, _FILE_STATE.size, 0)
+                if len(data) == _FILE_STATE.size:
+                    self._tokens, self._updated = _FILE_STATE.unpack(data)
+                else:
+                    self._tokens, self._updated = float(self.capacity), self.clock()
+                yield
+                os.pwrite(fd, _FILE_STATE.pack(self._tokens, self._updated), 0)
+            finally:
+                os.close(fd)
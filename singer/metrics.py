@@ -61,6 +61,10 @@ class Metric:
     record_count = 'record_count'
     job_duration = 'job_duration'
     http_request_duration = 'http_request_duration'
+    transform_duration = 'transform_duration'
+    rate_limit_wait = 'rate_limit_wait'
+    http_retry_wait = 'http_retry_wait'
+    http_retry_count = 'http_retry_count'
 
 
 class Tag:
@@ -70,6 +74,8 @@ class Tag:
     job_type = 'job_type'
     http_status_code = 'http_status_code'
     status = 'status'
+    path = 'path'
+    attempt = 'attempt'
 
 
 
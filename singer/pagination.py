@@ -0,0 +1,97 @@
+'''Overlap fetching pages from an API with processing their records.
+
+A tap usually fetches a page, transforms and writes its records, then
+fetches the next page, so it is either waiting on the network or busy
+with records but never both. prefetch_pages takes a function
+
+    fetch_page(cursor) -> (records, next_cursor)
+
+and calls it on a background thread, running up to `prefetch` pages ahead
+of the caller. Pages are delivered in order. Each cursor comes from the
+previous page, so pages are fetched one after another; what overlaps is
+fetching with the caller's work. The first page is fetched with the cursor
+passed in, and fetching stops when next_cursor is None.
+
+    def fetch_page(cursor):
+        response = client.get("/users", params={"page_token": cursor})
+        return response["users"], response.get("next_page_token")
+
+    with singer.metrics.record_counter("users") as counter:
+        for record in prefetch_records(fetch_page, counter=counter):
+            singer.write_record("users", record)
+
+If fetch_page raises, the pages fetched before the error are delivered and
+then the error is raised to the caller. If the caller stops iterating or
+raises, no further pages are fetched.
+'''
+
+import queue
+import threading
+
+DEFAULT_PREFETCH = 2
+
+# How often a fetching thread blocked on a full queue checks whether the
+# caller has gone away.
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+def prefetch_pages(fetch_page, cursor=None, prefetch=DEFAULT_PREFETCH):
+    '''Yield the records of each page returned by fetch_page, in order,
+    while fetching up to prefetch pages ahead on a background thread.'''
+    if prefetch < 1:
+        raise ValueError("prefetch must be at least 1")
+
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_all():
+        next_cursor = cursor
+        try:
+            while not stop.is_set():
+                records, next_cursor = fetch_page(next_cursor)
+                if not put((records, None)):
+                    return
+                if next_cursor is None:
+                    break
+        except BaseException as exc:  # pylint: disable=broad-except
+            put((None, exc))
+            return
+        put(_DONE)
+
+    fetcher = threading.Thread(target=fetch_all, name="singer-prefetch", daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is _DONE:
+                break
+            records, exc = item
+            if exc is not None:
+                raise exc
+            yield records
+    finally:
+        # A fetch in flight cannot be interrupted; the thread exits once it
+        # returns and sees that we have stopped.
+        stop.set()
+    fetcher.join()
+
+
+def prefetch_records(fetch_page, cursor=None, prefetch=DEFAULT_PREFETCH, counter=None):
+    '''Yield every record from prefetch_pages, incrementing counter (such
+    as a metrics.record_counter) for each one.'''
+    for records in prefetch_pages(fetch_page, cursor=cursor, prefetch=prefetch):
+        for record in records:
+            if counter is not None:
+                counter.increment()
+            yield record
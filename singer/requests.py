@@ -1,6 +1,55 @@
+import time
+
+# Rate limit reset headers larger than this are epoch timestamps rather
+# than a number of seconds to wait.
+EPOCH_RESET_THRESHOLD = 10**9
+
+RATE_LIMIT_RESET_HEADERS = ('ratelimit-reset', 'x-ratelimit-reset', 'x-rate-limit-reset')
+
+
 def giveup_on_http_4xx_except_429(error):
     response = error.response
     if response is None:
         return False
     return not (response.status_code == 429 or
                 response.status_code >= 500)
+
+
+def retry_after_seconds(response, now=None):
+    """Seconds the server asked us to wait before retrying, from the
+    Retry-After header or a rate limit reset header on response, or None
+    if it did not say.
+
+    >>> class Response: headers = {'Retry-After': '7'}
+    >>> retry_after_seconds(Response())
+    7.0
+    """
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    headers = {name.lower(): value for name, value in headers.items()}
+    now = time.time() if now is None else now
+
+    retry_after = headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            import email.utils  # pylint: disable=import-outside-toplevel
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                retry_at = None
+            if retry_at is not None:
+                return max(0.0, retry_at.timestamp() - now)
+
+    for name in RATE_LIMIT_RESET_HEADERS:
+        try:
+            reset = float(headers[name])
+        except (KeyError, ValueError):
+            continue
+        if reset > EPOCH_RESET_THRESHOLD:
+            reset -= now
+        return max(0.0, reset)
+
+    return None
@@ -1,11 +1,16 @@
+import collections
 import datetime
-import decimal
+import functools
 import logging
 import re
-from jsonschema import RefResolver
+import threading
+from urllib.parse import urljoin
 
 import singer.metadata
 from singer.logger import get_logger
+from singer.transform_columnar import ColumnarMixin
+from singer.transform_common import SchemaKey, _MISSING, decimal_to_string
+from singer.transform_shapes import ShapeCacheMixin
 from singer.utils import (strftime, strptime_to_utc)
 
 LOGGER = get_logger()
@@ -37,6 +42,50 @@ def unix_seconds_to_datetime(value):
     return strftime(datetime.datetime.fromtimestamp(int(value), datetime.timezone.utc))
 
 
+def normalize_datetime(value, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING):
+    """
+    Convert value to a singer date-time string, returning None if it can't be
+    parsed. Integers are read as unix seconds or milliseconds when
+    integer_datetime_fmt asks for it.
+    """
+    if integer_datetime_fmt == NO_INTEGER_DATETIME_PARSING:
+        return string_to_datetime(value)
+
+    try:
+        if integer_datetime_fmt == UNIX_SECONDS_INTEGER_DATETIME_PARSING:
+            return unix_seconds_to_datetime(value)
+        else:
+            return unix_milliseconds_to_datetime(value)
+    except:
+        return string_to_datetime(value)
+
+
+# Streams tend to repeat the same timestamps, so normalized date-times are
+# memoized. typed=True keeps 1, 1.0 and True apart.
+DEFAULT_DATETIME_CACHE_SIZE = 4096
+
+_cached_normalize_datetime = functools.lru_cache(
+    maxsize=DEFAULT_DATETIME_CACHE_SIZE, typed=True)(normalize_datetime)
+
+
+def set_datetime_cache_size(maxsize):
+    """
+    Replace the date-time normalization cache with an empty one holding at
+    most maxsize entries. A maxsize of 0 disables caching.
+    """
+    global _cached_normalize_datetime # pylint: disable=global-statement
+    _cached_normalize_datetime = functools.lru_cache(
+        maxsize=maxsize, typed=True)(normalize_datetime)
+
+
+def datetime_cache_info():
+    """
+    Return the hits, misses, maxsize and currsize of the date-time
+    normalization cache.
+    """
+    return _cached_normalize_datetime.cache_info()
+
+
 def breadcrumb_path(breadcrumb):
     """
     Transform breadcrumb into familiar object dot-notation
@@ -59,13 +108,6 @@ class SchemaMismatch(Exception):
 
         super().__init__(msg)
 
-class SchemaKey:
-    ref = "$ref"
-    items = "items"
-    properties = "properties"
-    pattern_properties = "patternProperties"
-    any_of = 'anyOf'
-
 class Error:
     def __init__(self, path, data, schema=None, logging_level=logging.INFO):
         self.path = path
@@ -90,30 +132,146 @@ class Error:
         return output
 
 
-class Transformer:
-    def __init__(self, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING, pre_hook=None):
+# Stands for every element of an array in a FieldHook path
+_ITEMS = object()
+
+
+class FieldHook:
+    """
+    A record_hook that calls func once with each value found at the given
+    paths, replacing the value with what func returns. Paths use the same
+    dot-notation as the filtered paths Transformer logs, with [] for the
+    elements of an array, e.g. "created_at" or "lines[].amount". Records
+    are updated in place.
+
+    transformer = Transformer(record_hook=FieldHook(parse_cents, ["lines[].amount"]))
+    """
+    def __init__(self, func, paths):
+        self.func = func
+        self.paths = [self._parse_path(path) for path in paths]
+
+    @staticmethod
+    def _parse_path(path):
+        steps = []
+        for name in path.split("."):
+            items = 0
+            while name.endswith("[]"):
+                name = name[:-2]
+                items += 1
+            if name:
+                steps.append(name)
+            steps.extend([_ITEMS] * items)
+        return steps
+
+    def __call__(self, record):
+        for steps in self.paths:
+            record = self._apply(record, steps, 0)
+        return record
+
+    def _apply(self, data, steps, i):
+        if i == len(steps):
+            return self.func(data)
+
+        if steps[i] is _ITEMS:
+            if isinstance(data, list):
+                for j, value in enumerate(data):
+                    data[j] = self._apply(value, steps, i + 1)
+        elif isinstance(data, dict) and steps[i] in data:
+            data[steps[i]] = self._apply(data[steps[i]], steps, i + 1)
+        return data
+
+
+class Transformer(ShapeCacheMixin, ColumnarMixin): # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING, pre_hook=None,
+                 in_place=False, shape_cache=False, record_hook=None, batch_hook=None):
         self.integer_datetime_fmt = integer_datetime_fmt
+        # Called with every value and every type tried for it
         self.pre_hook = pre_hook
+        # Called once with each record, and once with each batch of records
+        # given to transform_columnar or each chunk a TransformPool hands to
+        # a worker, before the type pass. Both return what should be
+        # transformed instead. See FieldHook for a record_hook that only
+        # looks at some paths.
+        self.record_hook = record_hook
+        self.batch_hook = batch_hook
+        # When set, dicts and lists in the input are updated rather than
+        # rebuilt. A record that fails to transform may be left partially
+        # converted.
+        self.in_place = in_place
+        # When set, transform remembers how each record shape (its keys and
+        # the Python type of each value) is handled and reuses that plan for
+        # later records with the same shape. See singer.transform_shapes.
+        self.shape_cache = shape_cache
+        self._shapes = {}
+        self._shapes_for = None
+        self._shapes_enabled = False
+        self._shape_hits = 0
+        # Dot-separated paths removed because they weren't in the schema, and
+        # paths filtered because they were unsupported or not selected
         self.removed = set()
         self.filtered = set()
+        # Number of times each path was removed or filtered, keyed by the
+        # path (or breadcrumb) as a tuple, and the name each has in removed
+        # or filtered, so that names are built once per path
+        self.removed_counts = collections.Counter()
+        self.filtered_counts = collections.Counter()
+        self._removed_names = {}
+        self._filtered_names = {}
         self.errors = []
+        # Greater than zero while anyOf branches are being tried. Failed
+        # branches are expected then, so no Error is recorded for them.
+        self._probing = 0
+        # Greater than zero while a value is tried against one of several
+        # types. Another type may still read the value if this one fails, so
+        # it must not be mutated.
+        self._speculative = 0
+
+    def _removed_name(self, path):
+        name = self._removed_names.get(path)
+        if name is None:
+            name = self._removed_names[path] = ".".join(map(str, path))
+        return name
+
+    def _filtered_name(self, breadcrumb):
+        name = self._filtered_names.get(breadcrumb)
+        if name is None:
+            name = self._filtered_names[breadcrumb] = breadcrumb_path(breadcrumb)
+        return name
+
+    def _count_removed(self, path, count=1):
+        self.removed_counts[path] += count
+        self.removed.add(self._removed_names.get(path) or self._removed_name(path))
+
+    def _count_filtered(self, breadcrumb, count=1):
+        self.filtered_counts[breadcrumb] += count
+        self.filtered.add(self._filtered_names.get(breadcrumb) or self._filtered_name(breadcrumb))
 
     def log_warning(self):
         if self.filtered:
+            filtered = sorted(self.filtered)
+            counts = collections.Counter()
+            for breadcrumb, count in self.filtered_counts.items():
+                counts[breadcrumb_path(breadcrumb)] += count
             LOGGER.debug("Filtered %s paths during transforms "
                          "as they were unsupported or not selected:\n\t%s",
-                         len(self.filtered),
-                         "\n\t".join(sorted(self.filtered)))
+                         len(filtered),
+                         "\n\t".join(filtered))
             # Output list format to parse for reporting
-            LOGGER.debug("Filtered paths list: %s",
-                         sorted(self.filtered))
+            LOGGER.debug("Filtered paths list: %s", filtered)
+            LOGGER.debug("Filtered path counts: %s", {path: counts[path] for path in filtered})
 
         if self.removed:
+            removed = sorted(self.removed)
+            counts = collections.Counter()
+            for path, count in self.removed_counts.items():
+                counts[".".join(map(str, path))] += count
             LOGGER.debug("Removed %s paths during transforms:\n\t%s",
-                         len(self.removed),
-                         "\n\t".join(sorted(self.removed)))
+                         len(removed),
+                         "\n\t".join(removed))
             # Output list format to parse for reporting
-            LOGGER.debug("Removed paths list: %s", sorted(self.removed))
+            LOGGER.debug("Removed paths list: %s", removed)
+            LOGGER.debug("Removed path counts: %s", {path: counts[path] for path in removed})
 
     def __enter__(self):
         return self
@@ -134,7 +292,7 @@ class Transformer:
                     data.pop(field_name, None)
                     # Track that a field was filtered because the customer
                     # didn't select it or the tap declared it as unsupported.
-                    self.filtered.add(breadcrumb_path(breadcrumb))
+                    self._count_filtered(breadcrumb)
                 else:
                     data[field_name] = self.filter_data_by_metadata(
                         data[field_name], metadata, breadcrumb)
@@ -146,6 +304,14 @@ class Transformer:
         return data
 
     def transform(self, data, schema, metadata=None):
+        if self.record_hook:
+            data = self.record_hook(data)
+
+        if self.shape_cache and isinstance(data, dict):
+            transformed_data = self._transform_by_shape(data, schema, metadata)
+            if transformed_data is not _MISSING:
+                return transformed_data
+
         data = self.filter_data_by_metadata(data, metadata)
 
         success, transformed_data = self.transform_recur(data, schema, [])
@@ -154,6 +320,15 @@ class Transformer:
 
         return transformed_data
 
+    def _raise_schema_mismatch(self):
+        raise SchemaMismatch(self.errors)
+
+    def _transform_or_raise(self, data, schema):
+        success, transformed_data = self.transform_recur(data, schema, [])
+        if not success:
+            raise SchemaMismatch(self.errors)
+        return transformed_data
+
     def transform_recur(self, data, schema, path):
         if "anyOf" in schema:
             return self._transform_anyof(data, schema, path)
@@ -170,27 +345,74 @@ class Transformer:
             types.remove("null")
             types.append("null")
 
-        for typ in types:
-            success, transformed_data = self._transform(data, typ, schema, path)
-            if success:
-                return success, transformed_data
-        else: # pylint: disable=useless-else-on-loop
-            # exhaused all types and didn't return, so we failed :-(
+        speculative = self.in_place and len(types) - types.count("null") > 1
+        if speculative:
+            self._speculative += 1
+        try:
+            for typ in types:
+                success, transformed_data = self._transform(data, typ, schema, path)
+                if success:
+                    return success, transformed_data
+        finally:
+            if speculative:
+                self._speculative -= 1
+
+        # exhaused all types and didn't return, so we failed :-(
+        self._record_error(path, data, schema)
+        return False, None
+
+    def _record_error(self, path, data, schema):
+        if not self._probing:
             self.errors.append(Error(path, data, schema, logging_level=LOGGER.level))
-            return False, None
 
     def _transform_anyof(self, data, schema, path):
         subschemas = schema['anyOf']
-        for subschema in subschemas:
-            success, transformed_data = self.transform_recur(data, subschema, path)
-            if success:
-                return success, transformed_data
-            else:
-                self.errors.pop()
-        else: # pylint: disable=useless-else-on-loop
-            # exhaused all schemas and didn't return, so we failed :-(
-            self.errors.append(Error(path, data, schema, logging_level=LOGGER.level))
-            return False, None
+        self._probing += 1
+        try:
+            for subschema in subschemas:
+                success, transformed_data = self.transform_recur(data, subschema, path)
+                if success:
+                    return success, transformed_data
+        finally:
+            self._probing -= 1
+
+        # exhaused all schemas and didn't return, so we failed :-(
+        self._record_error(path, data, schema)
+        return False, None
+
+    def _transform_candidates(self, data, candidates, path):
+        """Try the (type, schema) candidates of a shape plan in order."""
+        if len(candidates) > 1:
+            self._probing += 1
+        try:
+            for typ, schema in candidates:
+                if typ is None:
+                    return True, data
+                success, transformed_data = self._transform(data, typ, schema, path)
+                if success:
+                    return success, transformed_data
+        finally:
+            if len(candidates) > 1:
+                self._probing -= 1
+
+        return False, None
+
+    def _can_mutate(self):
+        return self.in_place and not self._probing and not self._speculative
+
+    @staticmethod
+    def _property_schema(schema, pattern_properties, key):
+        if key in schema:
+            return schema[key]
+
+        # patternProperties are a map of {"pattern": { schema...}}
+        pattern_schemas = [schema for pattern, schema
+                           in (pattern_properties or {}).items()
+                           if re.match(pattern, key)]
+        if pattern_schemas:
+            return {'anyOf': pattern_schemas}
+
+        return None
 
     def _transform_object(self, data, schema, path, pattern_properties):
         # We do not necessarily have a dict to transform here. The schema's
@@ -203,16 +425,18 @@ class Transformer:
         if schema == {} and not pattern_properties:
             return True, data
 
+        if self._can_mutate():
+            return self._transform_object_in_place(data, schema, path, pattern_properties)
+
         result = {}
         successes = []
         for key, value in data.items():
-            # patternProperties are a map of {"pattern": { schema...}}
-            pattern_schemas = [schema for pattern, schema
-                               in (pattern_properties or {}).items()
-                               if re.match(pattern, key)]
-            if key in schema or pattern_schemas:
-                sub_schema = schema.get(key, {'anyOf': pattern_schemas})
+            sub_schema = self._property_schema(schema, pattern_properties, key)
+            if sub_schema is not None:
                 success, subdata = self.transform_recur(value, sub_schema, path + [key])
+                if not success and self._probing:
+                    # Nobody will read the errors, so stop at the first one
+                    return False, None
                 successes.append(success)
                 result[key] = subdata
             else:
@@ -221,20 +445,57 @@ class Transformer:
                 # with discovery but rather than failing the run because
                 # new data was added we'd rather continue the sync and
                 # allow customers to indicate that they want the new data.
-                self.removed.add(".".join(map(str, path + [key])))
+                self._count_removed((*path, key))
 
         return all(successes), result
 
+    def _transform_object_in_place(self, data, schema, path, pattern_properties):
+        removed_keys = None
+        for key, value in data.items():
+            sub_schema = self._property_schema(schema, pattern_properties, key)
+            if sub_schema is not None:
+                success, subdata = self.transform_recur(value, sub_schema, path + [key])
+                if not success:
+                    return False, None
+                if subdata is not value:
+                    # Replacing the value of an existing key is safe while
+                    # iterating
+                    data[key] = subdata
+            else:
+                # See _transform_object for why this isn't a failure
+                self._count_removed((*path, key))
+                if removed_keys is None:
+                    removed_keys = []
+                removed_keys.append(key)
+
+        if removed_keys:
+            for key in removed_keys:
+                del data[key]
+
+        return True, data
+
     def _transform_array(self, data, schema, path):
         # We do not necessarily have a list to transform here. The schema's
         # type could contain multiple possible values. Eg:
         #     ["null", "array", "integer"]
         if not isinstance(data, list):
             return False, data
+
+        if self._can_mutate():
+            for i, row in enumerate(data):
+                success, subdata = self.transform_recur(row, schema, path + [i])
+                if not success:
+                    return False, None
+                if subdata is not row:
+                    data[i] = subdata
+            return True, data
+
         result = []
         successes = []
         for i, row in enumerate(data):
             success, subdata = self.transform_recur(row, schema, path + [i])
+            if not success and self._probing:
+                return False, None
             successes.append(success)
             result.append(subdata)
 
@@ -247,16 +508,11 @@ class Transformer:
         if self.integer_datetime_fmt not in VALID_DATETIME_FORMATS:
             raise Exception("Invalid integer datetime parsing option")
 
-        if self.integer_datetime_fmt == NO_INTEGER_DATETIME_PARSING:
-            return string_to_datetime(value)
-        else:
-            try:
-                if self.integer_datetime_fmt == UNIX_SECONDS_INTEGER_DATETIME_PARSING:
-                    return unix_seconds_to_datetime(value)
-                else:
-                    return unix_milliseconds_to_datetime(value)
-            except:
-                return string_to_datetime(value)
+        try:
+            return _cached_normalize_datetime(value, self.integer_datetime_fmt)
+        except TypeError:
+            # Unhashable values (dicts, lists) can't be cached
+            return normalize_datetime(value, self.integer_datetime_fmt)
 
     def _transform(self, data, typ, schema, path):
         if self.pre_hook:
@@ -275,24 +531,10 @@ class Transformer:
 
             return True, data
         elif typ == "string" and schema.get("format") == "singer.decimal":
-            if data is None:
+            try:
+                return True, decimal_to_string(data)
+            except:
                 return False, None
-
-            if isinstance(data, (str, float, int)):
-                try:
-                    return True, str(decimal.Decimal(str(data)))
-                except:
-                    return False, None
-            elif isinstance(data, decimal.Decimal):
-                try:
-                    if data.is_snan():
-                        return True, 'NaN'
-                    else:
-                        return True, str(data)
-                except:
-                    return False, None
-
-            return False, None
         elif typ == "object":
             # Objects do not necessarily specify properties
             return self._transform_object(data,
@@ -344,7 +586,7 @@ class Transformer:
 
 
 def transform(data, schema, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING,
-              pre_hook=None, metadata=None):
+              pre_hook=None, metadata=None, *, in_place=False, record_hook=None):
     """
     Applies schema (and integer_datetime_fmt, if supplied) to data, transforming
     each field in data to the type specified in schema. If no type matches a
@@ -360,22 +602,157 @@ def transform(data, schema, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING,
     time formats are appropriately parsed as unix seconds or unix milliseconds.
 
     The pre_hook should be a callable that takes data, type, and schema and
-    returns the transformed data to be fed into the _transform function.
+    returns the transformed data to be fed into the _transform function. It
+    is called for every value and every type tried for it; a record_hook,
+    which takes the whole record and returns the record to transform, is
+    called just once.
+
+    If in_place is True, dicts and lists in data are updated instead of
+    copied, and the returned value shares them with data.
+
+    Transformers are reused across calls with an equal schema, metadata and
+    options, so records of a stream can take advantage of the Transformer's
+    shape cache, even when the schema is rebuilt for each record, e.g. by
+    Schema.to_dict(). The cached Transformer works on its own copy of the
+    schema and metadata, so later changes to them take effect as usual.
     """
-    transformer = Transformer(integer_datetime_fmt, pre_hook)
+    schema, metadata, transformer = _cached_transformer(
+        schema, metadata,
+        integer_datetime_fmt=integer_datetime_fmt,
+        pre_hook=pre_hook,
+        in_place=in_place,
+        record_hook=record_hook)
+    transformer.errors = []
     return transformer.transform(data, schema, metadata=metadata)
 
+
+# Most Transformers transform() keeps per thread
+MAX_CACHED_TRANSFORMERS = 64
+
+# Transformers carry per-call state, so each thread gets its own
+_TRANSFORMERS = threading.local()
+
+# A Transformer cached by transform(). schema and metadata are the objects
+# it was cached for, which keeps their ids from being reused while the entry
+# exists. expected_schema and expected_metadata are copies of them taken at
+# the time, and result holds the copies the Transformer is given.
+_CachedTransformer = collections.namedtuple(
+    '_CachedTransformer',
+    ['schema', 'metadata', 'expected_schema', 'expected_metadata', 'result'])
+
+
+def _snapshot(value, memo, ancestors):
+    """
+    Copy the dicts and lists in value, sharing what is shared in value.
+    Raises ValueError if one of them contains itself.
+    """
+    if not isinstance(value, (dict, list)):
+        return value
+    if id(value) in memo:
+        return memo[id(value)]
+    if id(value) in ancestors:
+        raise ValueError("Cannot copy a value that contains itself")
+
+    ancestors.add(id(value))
+    if isinstance(value, dict):
+        copied = {key: _snapshot(item, memo, ancestors) for key, item in value.items()}
+    else:
+        copied = [_snapshot(item, memo, ancestors) for item in value]
+    ancestors.discard(id(value))
+    memo[id(value)] = copied
+    return copied
+
+
+def _cached_transformer(schema, metadata, **options):
+    """
+    Return the schema, metadata and Transformer cached for schema, metadata
+    and options. The returned schema and metadata are equal to the ones
+    passed in, and are what the Transformer should be given so that its
+    shape cache carries over.
+    """
+    transformers = getattr(_TRANSFORMERS, "cache", None)
+    if transformers is None:
+        transformers = _TRANSFORMERS.cache = {}
+
+    # Hooks need not be hashable, so they are keyed by id. The cached
+    # Transformer holds them, so their ids can't be reused meanwhile.
+    option_key = tuple(sorted((name, id(value) if callable(value) else value)
+                              for name, value in options.items()))
+    key = (id(schema), id(metadata), option_key)
+    cached = transformers.get(key)
+    if (cached is not None and cached.schema is schema and cached.metadata is metadata
+            and cached.expected_schema == schema and cached.expected_metadata == metadata):
+        return cached.result
+
+    # Taps often build the schema and metadata again for every record, e.g.
+    # with Schema.to_dict(), so look for equal ones before giving up. Dicts
+    # that differ rarely get past comparing their lengths and first keys.
+    # The copies have no cycles, so comparing them always ends.
+    for (_, _, cached_options), cached in transformers.items():
+        if (cached_options == option_key and cached.expected_schema == schema
+                and cached.expected_metadata == metadata):
+            return cached.result
+
+    try:
+        expected = (_snapshot(schema, {}, set()), _snapshot(metadata, {}, set()))
+    except ValueError:
+        # A schema that contains itself can't be compared, so it isn't cached
+        return schema, metadata, Transformer(**options)
+    result = (_snapshot(schema, {}, set()), _snapshot(metadata, {}, set()),
+              Transformer(shape_cache=True, **options))
+
+    if len(transformers) >= MAX_CACHED_TRANSFORMERS:
+        transformers.clear()
+    transformers[key] = _CachedTransformer(schema, metadata, *expected, result)
+    return result
+
 def _transform_datetime(value, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING):
     transformer = Transformer(integer_datetime_fmt)
     return transformer._transform_datetime(value)
 
+# Most ref stores to keep a RefResolver for
+MAX_CACHED_RESOLVERS = 32
+
+# RefResolvers keyed by the id of their ref store. Each entry holds the
+# store itself too, so its id can't be reused while it is cached.
+_RESOLVERS = {}
+_RESOLVERS_LOCK = threading.Lock()
+
+
+def _get_resolver(schema, refs):
+    key = id(refs) if refs else None
+    cached = _RESOLVERS.get(key)
+    if cached is not None and cached[0] is (refs or None):
+        resolver = cached[1]
+        # Internal refs are resolved against the schema being walked
+        resolver.referrer = schema
+        resolver.store[""] = schema
+        return resolver
+
+    from jsonschema import RefResolver  # pylint: disable=import-outside-toplevel
+    resolver = RefResolver("", schema, store=refs or {})
+    if len(_RESOLVERS) >= MAX_CACHED_RESOLVERS:
+        _RESOLVERS.clear()
+    _RESOLVERS[key] = (refs or None, resolver)
+    return resolver
+
+
 def resolve_schema_references(schema, refs=None):
     '''Resolves and replaces json-schema $refs with the appropriate dict.
 
     Recursively walks the given schema dict, converting every instance
     of $ref in a 'properties' structure with a resolved dict.
 
-    This modifies the input schema and also returns it.
+    This modifies the input schema and also returns it. Referenced schemata
+    in refs are not modified. Each reference is resolved once per call and
+    every use of it shares the same dict. A reference back to a definition
+    that is still being resolved, as in a schema that refers to itself, is
+    left as a $ref to the definition's absolute URL, so the result is still
+    a tree that can be written out. transform passes values under such a
+    $ref through unchanged.
+
+    A RefResolver is kept for each refs store, so refs should not be
+    changed once it has been passed in.
 
     Arguments:
         schema:
@@ -386,29 +763,73 @@ def resolve_schema_references(schema, refs=None):
     Returns:
         schema
     '''
-    refs = refs or {}
-    return _resolve_schema_references(schema, RefResolver("", schema, store=refs))
+    with _RESOLVERS_LOCK:
+        resolver = _get_resolver(schema, refs)
+        result = _resolve_schema_references(schema, resolver, {})
+
+    if result is not schema:
+        # schema was nothing but a $ref
+        schema.update(result)
+    return schema
+
+def _resolve_reference(reference_path, resolver, resolved):
+    # RefResolver.resolve caches by URL, which would keep serving a previous
+    # schema's internal refs from a reused resolver
+    url = urljoin(resolver.resolution_scope, reference_path)
+    target = resolved.get(url)
+    if target is _MISSING:
+        # The definition refers back to itself, so inlining it would never
+        # end. Keep a reference that is valid outside this scope instead.
+        return {SchemaKey.ref: url}
+    if target is not None:
+        return target
+
+    definition = resolver.resolve_from_url(url)
+    resolved[url] = _MISSING
+    resolver.push_scope(url)
+    try:
+        target = _resolve_schema_references(definition, resolver, resolved, copy=True)
+    finally:
+        resolver.pop_scope()
+    resolved[url] = target
+    return target
+
+def _resolve_schema_references(schema, resolver, resolved, copy=False):
+    """
+    Resolve the $refs in schema. With copy set, schema belongs to a ref
+    store, so each dict and list on the way is copied instead of modified.
+    Returns the resolved schema, which is a shared dict if schema was
+    nothing but a $ref.
+    """
+    if not isinstance(schema, dict):
+        return schema
 
-def _resolve_schema_references(schema, resolver):
-    if SchemaKey.ref in schema:
-        reference_path = schema.pop(SchemaKey.ref, None)
-        resolved = resolver.resolve(reference_path)[1]
-        schema.update(resolved)
-        return _resolve_schema_references(schema, resolver)
+    if copy:
+        schema = dict(schema)
 
-    if SchemaKey.properties in schema:
-        for k, val in schema[SchemaKey.properties].items():
-            schema[SchemaKey.properties][k] = _resolve_schema_references(val, resolver)
+    reference_path = schema.pop(SchemaKey.ref, None)
 
-    if SchemaKey.pattern_properties in schema:
-        for k, val in schema[SchemaKey.pattern_properties].items():
-            schema[SchemaKey.pattern_properties][k] = _resolve_schema_references(val, resolver)
+    for key in (SchemaKey.properties, SchemaKey.pattern_properties):
+        if key in schema:
+            subschemas = dict(schema[key]) if copy else schema[key]
+            for k, val in subschemas.items():
+                subschemas[k] = _resolve_schema_references(val, resolver, resolved, copy)
+            schema[key] = subschemas
 
     if SchemaKey.items in schema:
-        schema[SchemaKey.items] = _resolve_schema_references(schema[SchemaKey.items], resolver)
+        schema[SchemaKey.items] = _resolve_schema_references(schema[SchemaKey.items],
+                                                             resolver, resolved, copy)
 
     if SchemaKey.any_of in schema:
-        for i, element in enumerate(schema[SchemaKey.any_of]):
-            schema[SchemaKey.any_of][i] = _resolve_schema_references(element, resolver)
+        elements = list(schema[SchemaKey.any_of]) if copy else schema[SchemaKey.any_of]
+        for i, element in enumerate(elements):
+            elements[i] = _resolve_schema_references(element, resolver, resolved, copy)
+        schema[SchemaKey.any_of] = elements
+
+    if reference_path is not None:
+        target = _resolve_reference(reference_path, resolver, resolved)
+        if not schema:
+            return target
+        schema.update(target)
 
     return schema
@@ -0,0 +1,193 @@
+'''Columnar batch transforms for Transformer.
+
+transform_columnar pivots a batch of records into one column per top-level
+property and converts each column of plain values in a single loop, with
+numpy when it is installed. It returns the same records transform would.
+'''
+
+import collections
+import functools
+import itertools
+
+from singer.transform_common import (SchemaKey, _MISSING, _as_list, _to_boolean, _to_integer,
+                                     _to_number, _to_string, decimal_to_string)
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    """numpy, imported the first time a column could use it, or None if it
+    isn't installed."""
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return numpy
+
+
+def _vectorized_column(column, convert):
+    """
+    Convert a column of integers or numbers with numpy, returning None if
+    numpy isn't installed or the column holds anything but plain numbers.
+    """
+    numpy = _numpy()
+    if numpy is None:
+        return None
+
+    try:
+        array = numpy.asarray(column)
+    except Exception:
+        return None
+
+    if array.ndim != 1:
+        return None
+    if convert is _to_integer and array.dtype.kind in "iu":
+        return array.tolist()
+    if convert is _to_integer and array.dtype.kind == "b":
+        return array.astype(numpy.int64).tolist()
+    if convert is _to_number and array.dtype.kind in "biuf":
+        return array.astype(numpy.float64).tolist()
+    return None
+
+class ColumnarMixin:
+    """The columnar transform methods of Transformer."""
+
+    def transform_columnar(self, records, schema, metadata=None):
+        """
+        Transform a batch of records, returning a list of the results.
+
+        Records are pivoted into one column per top-level property, and each
+        column of integers, numbers, strings, booleans, date-times or
+        singer.decimals is converted in a single loop (vectorized with numpy
+        when it is installed). Other properties are transformed value by
+        value. Results are the same as calling transform on each record.
+        """
+        if self.batch_hook:
+            records = self.batch_hook(records)
+        if self.record_hook:
+            records = [self.record_hook(record) for record in records]
+        records = [self.filter_data_by_metadata(record, metadata) for record in records]
+
+        if (self.pre_hook or "anyOf" in schema
+                or [t for t in _as_list(schema.get("type")) if t != "null"] != ["object"]
+                or schema.get(SchemaKey.pattern_properties)
+                or not all(isinstance(record, dict) for record in records)):
+            return [self._transform_or_raise(record, schema) for record in records]
+
+        properties = schema.get("properties", {})
+        if properties == {}:
+            return records
+
+        # Paths removed from the batch are counted apart until every column
+        # has succeeded, since a failure means they were counted for records
+        # after the failing one
+        removed, self.removed = self.removed, set()
+        removed_counts, self.removed_counts = self.removed_counts, collections.Counter()
+        try:
+            columns, failed_row = self._transform_columns(records, properties)
+        finally:
+            attempted = (self.removed, self.removed_counts)
+            self.removed, self.removed_counts = removed, removed_counts
+
+        if failed_row is not None:
+            # Transform the records up to the failing one again, as transform
+            # would have, to count their removed paths and collect errors
+            for record in records[:failed_row + 1]:
+                self.transform_recur(record, schema, [])
+            self._raise_schema_mismatch()
+
+        self.removed.update(attempted[0])
+        self.removed_counts.update(attempted[1])
+        return [{key: columns[key][i] for key in record if key in columns}
+                for i, record in enumerate(records)]
+
+    def _transform_columns(self, records, properties):
+        """
+        Convert each column of records. Returns the converted columns by key
+        and the first record that failed, or None.
+        """
+        columns = {}
+        failed_row = None
+        error_count = len(self.errors)
+        for key in dict.fromkeys(itertools.chain.from_iterable(records)):
+            if key not in properties:
+                # See _transform_object for why this isn't a failure
+                self._count_removed((key,), sum(1 for record in records if key in record))
+                continue
+
+            column = [record.get(key, _MISSING) for record in records]
+            converted, failed_at = self._transform_column(column, properties[key], key)
+            if failed_at is not None and (failed_row is None or failed_at < failed_row):
+                failed_row = failed_at
+            columns[key] = converted
+
+        # Errors from columns are incomplete, and are collected again
+        del self.errors[error_count:]
+        return columns, failed_row
+
+    def _column_converter(self, schema):
+        """
+        Return a function converting one value for schema, raising on
+        failure, or None if values must go through transform_recur.
+        """
+        types = [t for t in _as_list(schema.get("type")) if t != "null"]
+        if "anyOf" in schema or len(types) != 1:
+            return None
+
+        typ = types[0]
+        if typ == "string" and schema.get("format") == "date-time":
+            def to_datetime(value):
+                result = self._transform_datetime(value)
+                if result is None:
+                    raise ValueError(f"{value!r} is not a date-time")
+                return result
+            return to_datetime
+        elif typ == "string" and schema.get("format") == "singer.decimal":
+            return decimal_to_string
+
+        return {"integer": _to_integer,
+                "number": _to_number,
+                "string": _to_string,
+                "boolean": _to_boolean}.get(typ)
+
+    def _transform_column(self, column, schema, key):
+        """
+        Convert column, a list of the values of key in each record.
+
+        Returns the converted list and the index of the first value that
+        failed, or None.
+        """
+        if "anyOf" not in schema and "type" not in schema:
+            return column, None
+
+        convert = self._column_converter(schema)
+        if convert is None:
+            converted = []
+            for i, value in enumerate(column):
+                if value is _MISSING:
+                    converted.append(value)
+                    continue
+                success, subdata = self.transform_recur(value, schema, [key])
+                if not success:
+                    return converted, i
+                converted.append(subdata)
+            return converted, None
+
+        if convert in (_to_integer, _to_number):
+            vectorized = _vectorized_column(column, convert)
+            if vectorized is not None:
+                return vectorized, None
+
+        nullable = "null" in _as_list(schema["type"])
+        converted = []
+        for i, value in enumerate(column):
+            if value is _MISSING:
+                converted.append(value)
+                continue
+            try:
+                converted.append(convert(value))
+            except Exception:
+                if nullable and (value is None or value == ""):
+                    converted.append(None)
+                else:
+                    return converted, i
+        return converted, None
@@ -0,0 +1,79 @@
+'''Value conversions and schema helpers shared by Transformer, its shape
+cache and its columnar engine.'''
+
+import decimal
+import re
+
+
+# Decimal strings that str(decimal.Decimal(...)) returns unchanged: no
+# exponent, no leading zeros, and no more than five zeros after "0." since
+# smaller numbers are written in scientific notation
+_CANONICAL_DECIMAL = re.compile(r"-?(?:[1-9][0-9]*(?:\.[0-9]+)?|0(?:\.0{0,5}[1-9][0-9]*)?)")
+
+
+def decimal_to_string(value):
+    """
+    Convert value to the string form of a singer.decimal, raising an
+    exception if it isn't a number.
+    """
+    # Ints and canonical strings come out of Decimal unchanged, so skip it
+    value_type = type(value)
+    if value_type is int:
+        return str(value)
+    if value_type is str and _CANONICAL_DECIMAL.fullmatch(value):
+        return value
+
+    if isinstance(value, (str, float, int)):
+        return str(decimal.Decimal(str(value)))
+    elif isinstance(value, decimal.Decimal):
+        if value.is_snan():
+            return 'NaN'
+        else:
+            return str(value)
+
+    raise ValueError(f"{value!r} is not a decimal")
+
+
+def _to_integer(value):
+    if isinstance(value, str):
+        value = value.replace(",", "")
+    return int(value)
+
+
+def _to_number(value):
+    if isinstance(value, str):
+        value = value.replace(",", "")
+    return float(value)
+
+
+def _to_string(value):
+    if value is None:
+        raise ValueError("None is not a string")
+    return str(value)
+
+
+def _to_boolean(value):
+    if isinstance(value, str) and value.lower() == "false":
+        return False
+    return bool(value)
+
+
+# Sentinel for a key a record in a columnar batch doesn't have, and for a
+# record the shape cache didn't transform
+_MISSING = object()
+
+
+class SchemaKey:
+    ref = "$ref"
+    items = "items"
+    properties = "properties"
+    pattern_properties = "patternProperties"
+    any_of = 'anyOf'
+
+
+def _as_list(types):
+    if types is None:
+        return []
+    if isinstance(types, list):
+        return types
+    return [types]
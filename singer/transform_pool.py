@@ -0,0 +1,124 @@
+'''Transform records across a pool of worker processes.'''
+
+import collections
+import itertools
+import os
+
+from singer.transform import SchemaMismatch, Transformer
+
+
+DEFAULT_PARALLEL_CHUNK_SIZE = 500
+
+# Chunks per worker process a TransformPool hands out before waiting for the
+# oldest one, so that records are only read as fast as they are transformed
+PENDING_CHUNKS_PER_PROCESS = 2
+
+# Set in each TransformPool worker by _init_transform_worker
+_WORKER_STATE = None
+
+
+def _init_transform_worker(schema, metadata, options):
+    global _WORKER_STATE # pylint: disable=global-statement
+    # Workers own unpickled copies of the records, so mutating them is safe
+    _WORKER_STATE = (schema, metadata, Transformer(in_place=True, **options))
+
+
+def _transform_chunk(records):
+    schema, metadata, transformer = _WORKER_STATE
+    transformer.removed_counts = collections.Counter()
+    transformer.filtered_counts = collections.Counter()
+    transformer.errors = []
+    if transformer.batch_hook:
+        records = transformer.batch_hook(records)
+    results = []
+    for record in records:
+        try:
+            results.append(transformer.transform(record, schema, metadata))
+        except SchemaMismatch:
+            # SchemaMismatch can't be rebuilt from its message, so send the
+            # errors back with the records before the failing one and let
+            # the parent raise it
+            return (results, transformer.removed_counts, transformer.filtered_counts,
+                    transformer.errors)
+    return results, transformer.removed_counts, transformer.filtered_counts, None
+
+
+class TransformPool:
+    """
+    Transforms batches of records across a pool of worker processes.
+
+    The schema and metadata are sent to each worker once, when it starts.
+    Records are transformed in chunks of chunk_size and yielded in their
+    original order. Records are read from the input only a few chunks ahead
+    of the ones being yielded, and the transformer's batch_hook is called
+    with each chunk. Paths removed or filtered by the workers are added to
+    the given Transformer, so its log_warning reports them as usual.
+
+    The transformer's hooks must be picklable, e.g. module-level functions.
+
+    with Transformer() as transformer:
+        with TransformPool(transformer, schema, mdata, processes=4) as pool:
+            for record in pool.transform(cursor):
+                singer.write_record(stream, record)
+    """
+    # pylint: disable=too-many-positional-arguments
+    def __init__(self, transformer, schema, metadata=None, processes=None,
+                 chunk_size=DEFAULT_PARALLEL_CHUNK_SIZE):
+        self.transformer = transformer
+        self.schema = schema
+        self.metadata = metadata
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.pool = None
+
+    def __enter__(self):
+        import multiprocessing  # pylint: disable=import-outside-toplevel
+        self.pool = multiprocessing.Pool(
+            self.processes,
+            initializer=_init_transform_worker,
+            initargs=(self.schema, self.metadata,
+                      {'integer_datetime_fmt': self.transformer.integer_datetime_fmt,
+                       'pre_hook': self.transformer.pre_hook,
+                       'record_hook': self.transformer.record_hook,
+                       'batch_hook': self.transformer.batch_hook}))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.pool.close()
+        else:
+            self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def _chunks(self, records):
+        iterator = iter(records)
+        while True:
+            chunk = list(itertools.islice(iterator, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def transform(self, records):
+        """Yield each of records transformed, in order. If a record fails,
+        the records before it are yielded and then SchemaMismatch is
+        raised."""
+        max_pending = PENDING_CHUNKS_PER_PROCESS * (self.processes or os.cpu_count() or 1)
+        pending = collections.deque()
+        for chunk in self._chunks(records):
+            pending.append(self.pool.apply_async(_transform_chunk, (chunk,)))
+            if len(pending) >= max_pending:
+                yield from self._chunk_results(pending.popleft().get())
+        while pending:
+            yield from self._chunk_results(pending.popleft().get())
+
+    def _chunk_results(self, chunk_result):
+        results, removed, filtered, errors = chunk_result
+        for path, count in removed.items():
+            self.transformer._count_removed(path, count)
+        for breadcrumb, count in filtered.items():
+            self.transformer._count_filtered(breadcrumb, count)
+        yield from results
+        if errors is not None:
+            self.transformer.errors.extend(errors)
+            raise SchemaMismatch(self.transformer.errors)
@@ -0,0 +1,116 @@
+'''Find out which fields make a transform slow.
+
+ProfilingTransformer is a Transformer that keeps a PathProfile for every
+schema path it transforms: how often the path was transformed and for how
+long, which type each value was converted to, which anyOf branch matched,
+and how many date-times fell back to dateutil. On exit it emits a
+transform_duration METRIC per path:
+
+    with ProfilingTransformer() as transformer:
+        for record in records:
+            singer.write_record(stream, transformer.transform(record, schema))
+
+A plain Transformer has none of this code on its path, so it pays nothing
+for profiling.
+'''
+
+import collections
+import time
+
+from singer import metrics
+from singer.logger import get_logger
+from singer.transform import Transformer
+from singer.utils import PARSE_STATS
+
+LOGGER = get_logger()
+
+
+class PathProfile:
+    """Statistics gathered for one schema path by a ProfilingTransformer."""
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        # Number of values converted to each type (or format)
+        self.types = collections.Counter()
+        # Number of values matched by each anyOf branch, by branch index
+        self.branches = collections.Counter()
+        # Number of date-times that fell back to dateutil
+        self.dateutil_fallbacks = 0
+
+
+def _schema_path(path):
+    """Name path like breadcrumb_path does, dropping array indexes."""
+    name = ""
+    for element in path:
+        if isinstance(element, int):
+            name += "[]"
+        elif name:
+            name += "." + str(element)
+        else:
+            name = str(element)
+    return name
+
+
+class ProfilingTransformer(Transformer):
+    """
+    A Transformer that records a PathProfile per schema path in profile.
+    Records are never transformed from a shape plan, since that would skip
+    the paths being measured.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.profile = collections.defaultdict(PathProfile)
+        # The schema that most recently transformed a value
+        self._profile_last = None
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.log_profile()
+
+    def log_profile(self):
+        """Emit a transform_duration METRIC for each profiled schema path."""
+        for path, stats in sorted(self.profile.items()):
+            tags = {metrics.Tag.path: path,
+                    'calls': stats.calls,
+                    'types': dict(stats.types)}
+            if stats.branches:
+                tags['anyof_branches'] = dict(stats.branches)
+            if stats.dateutil_fallbacks:
+                tags['dateutil_fallbacks'] = stats.dateutil_fallbacks
+            metrics.log(LOGGER, metrics.Point('timer', metrics.Metric.transform_duration,
+                                              stats.seconds, tags))
+
+    def _shapes_apply(self, schema):
+        return False
+
+    def transform_recur(self, data, schema, path):
+        stats = self.profile[_schema_path(path)]
+        start = time.perf_counter()
+        try:
+            success, transformed_data = super().transform_recur(data, schema, path)
+        finally:
+            stats.calls += 1
+            stats.seconds += time.perf_counter() - start
+
+        if success:
+            if "anyOf" in schema:
+                # The branch that matched was the last schema to succeed
+                for i, subschema in enumerate(schema["anyOf"]):
+                    if subschema is self._profile_last:
+                        stats.branches[i] += 1
+                        break
+            self._profile_last = schema
+        return success, transformed_data
+
+    def _transform(self, data, typ, schema, path):
+        fallbacks = PARSE_STATS['dateutil']
+        success, transformed_data = super()._transform(data, typ, schema, path)
+        stats = self.profile[_schema_path(path)]
+        if typ == "string":
+            stats.dateutil_fallbacks += PARSE_STATS['dateutil'] - fallbacks
+        if success:
+            if typ == "string" and schema.get("format") in ("date-time", "singer.decimal"):
+                stats.types[schema["format"]] += 1
+            else:
+                stats.types[typ] += 1
+        return success, transformed_data
@@ -0,0 +1,257 @@
+'''Record shape cache for Transformer.
+
+Most records of a stream have the same keys, with the same Python type of
+value under each key. With shape_cache set, a Transformer works out once
+per shape how each key is handled (converted, tried against the types that
+could match it, removed or filtered) and replays that plan for later
+records of the same shape, skipping schema interpretation, anyOf probing
+and metadata lookups.
+'''
+
+import collections
+import decimal
+
+import singer.metadata
+from singer.transform_common import SchemaKey, _MISSING, _as_list, _to_boolean
+
+
+# Most shapes a Transformer remembers for a schema
+MAX_RECORD_SHAPES = 1024
+
+# Once a Transformer has seen this many shapes for a schema, it stops using
+# them unless records matched a known shape more often than not. Building
+# a plan costs more than a plain transform, so streams whose records rarely
+# share a shape are better off without.
+RECORD_SHAPES_WARMUP = 32
+
+# Whether converting a value of some Python type to a schema type always
+# succeeds, never succeeds, or depends on the value itself
+_ALWAYS = "always"
+_NEVER = "never"
+_DEPENDS = "depends"
+
+_NoneType = type(None)
+_KNOWN_TYPES = (str, int, float, bool, dict, list, decimal.Decimal, _NoneType)
+
+
+def _candidate_outcome(typ, schema, value_type):
+    # pylint: disable=too-many-return-statements
+    if typ is None:
+        # No typing information, the value is passed through
+        return _ALWAYS
+    if value_type not in _KNOWN_TYPES:
+        return _DEPENDS
+
+    if typ == "null":
+        if value_type is _NoneType:
+            return _ALWAYS
+        return _DEPENDS if value_type is str else _NEVER
+    elif typ == "string":
+        if schema.get("format") == "date-time":
+            return _NEVER if value_type is _NoneType else _DEPENDS
+        if schema.get("format") == "singer.decimal":
+            return _NEVER if value_type in (_NoneType, dict, list) else _DEPENDS
+        return _NEVER if value_type is _NoneType else _ALWAYS
+    elif typ == "boolean":
+        return _ALWAYS
+    elif typ in ("integer", "number"):
+        if value_type in (_NoneType, dict, list):
+            return _NEVER
+        if value_type in (int, bool) or (typ == "number" and value_type is float):
+            return _ALWAYS
+        return _DEPENDS
+    elif typ == "object":
+        return _DEPENDS if value_type is dict else _NEVER
+    elif typ == "array":
+        return _DEPENDS if value_type is list else _NEVER
+
+    return _NEVER
+
+
+def _candidates(schema):
+    """
+    Flatten schema into the (type, schema) pairs transform_recur would try,
+    in order. A type of None stands for a schema without typing information.
+    """
+    if "anyOf" in schema:
+        return [candidate for subschema in schema["anyOf"]
+                for candidate in _candidates(subschema)]
+    if "type" not in schema:
+        return [(None, schema)]
+
+    types = _as_list(schema["type"])
+    if "null" in types:
+        types = [t for t in types if t != "null"] + ["null"]
+    return [(typ, schema) for typ in types]
+
+
+# Conversions for a sole candidate that can't fail for the value's type,
+# short of values out of range, such as an int too large for a float
+_INFALLIBLE_CONVERTERS = {
+    None: lambda value: value,
+    "null": lambda value: None,
+    "integer": int,
+    "number": float,
+    "string": str,
+    "boolean": _to_boolean,
+}
+
+# Actions in the steps of a record shape plan. A value that is removed is
+# only filtered, since it isn't part of the result.
+_FILTER = "filter"
+_CONVERT = "convert"
+_TRY = "try"
+
+
+# How a Transformer handles records of one shape. filtered holds the keys
+# filtered out with their breadcrumbs and names, steps the (key, action,
+# argument, breadcrumb to filter the value by, path) of each other key, and
+# removed the paths and names of keys that aren't in the schema. fallible
+# is set if a step tries several candidates, which may remove paths nested
+# in the value.
+_ShapePlan = collections.namedtuple('_ShapePlan', ['filtered', 'steps', 'removed', 'fallible'])
+
+
+def _plan_conversion(schema, value_type):
+    """
+    Return the plan action and argument converting a value of value_type
+    for schema: _CONVERT with a conversion that can't fail, or _TRY with
+    the candidates that might succeed.
+    """
+    # Drop candidates that can't succeed for this type of value, and any
+    # after one that always does
+    candidates = []
+    for typ, candidate_schema in _candidates(schema):
+        outcome = _candidate_outcome(typ, candidate_schema, value_type)
+        if outcome is not _NEVER:
+            candidates.append((typ, candidate_schema))
+        if outcome is _ALWAYS:
+            break
+
+    if (len(candidates) == 1 and candidates[0][0] in _INFALLIBLE_CONVERTERS
+            and _candidate_outcome(*candidates[0], value_type) is _ALWAYS):
+        return _CONVERT, _INFALLIBLE_CONVERTERS[candidates[0][0]]
+    return _TRY, candidates
+
+
+class ShapeCacheMixin:
+    """The shape cache methods of Transformer."""
+
+    def _shapes_apply(self, schema):
+        types = [t for t in _as_list(schema.get("type")) if t != "null"]
+        return (not self.pre_hook and not self.in_place
+                and "anyOf" not in schema and types == ["object"]
+                and bool(schema.get("properties") or schema.get(SchemaKey.pattern_properties)))
+
+    def _transform_by_shape(self, data, schema, metadata):
+        """
+        Transform data using the plan cached for its shape. Returns _MISSING
+        if shapes don't apply to schema.
+        """
+        if (self._shapes_for is None
+                or self._shapes_for[0] is not schema or self._shapes_for[1] is not metadata):
+            self._shapes_for = (schema, metadata)
+            self._shapes_enabled = self._shapes_apply(schema)
+            self._shapes = {}
+            self._shape_hits = 0
+        if not self._shapes_enabled:
+            return _MISSING
+
+        shape = (tuple(data), tuple(map(type, data.values())))
+        plan = self._shapes.get(shape)
+        if plan is None:
+            if (len(self._shapes) >= MAX_RECORD_SHAPES
+                    or (len(self._shapes) >= RECORD_SHAPES_WARMUP
+                        and self._shape_hits < len(self._shapes))):
+                self._shapes_enabled = False
+                self._shapes = {}
+                return _MISSING
+            plan = self._shapes[shape] = self._build_shape_plan(shape, schema, metadata)
+        else:
+            self._shape_hits += 1
+
+        error_count = len(self.errors)
+        if plan.fallible:
+            # Values tried against several candidates count their removals
+            # apart until the plan succeeds, so that a record transformed
+            # again below isn't counted twice
+            removed_counts, self.removed_counts = self.removed_counts, collections.Counter()
+            try:
+                result = self._apply_shape_plan(plan, data, metadata)
+            finally:
+                attempted, self.removed_counts = self.removed_counts, removed_counts
+            if result is not _MISSING:
+                removed_counts.update(attempted)
+        else:
+            result = self._apply_shape_plan(plan, data, metadata)
+
+        if result is _MISSING:
+            # Forget the attempt, finish filtering and transform again to
+            # collect errors
+            del self.errors[error_count:]
+            data = self.filter_data_by_metadata(data, metadata)
+            return self._transform_or_raise(data, schema)
+        return result
+
+    def _apply_shape_plan(self, plan, data, metadata):
+        """
+        Transform data by a plan, returning _MISSING if a value fails.
+        Removed paths are only counted once every value has succeeded.
+        """
+        for key, breadcrumb, name in plan.filtered:
+            data.pop(key, None)
+            self.filtered_counts[breadcrumb] += 1
+            self.filtered.add(name)
+
+        result = {}
+        for key, action, arg, nested_breadcrumb, path in plan.steps:
+            if nested_breadcrumb:
+                data[key] = self.filter_data_by_metadata(data[key], metadata, nested_breadcrumb)
+
+            if action is _CONVERT:
+                try:
+                    result[key] = arg(data[key])
+                except (ValueError, OverflowError):
+                    return _MISSING
+            elif action is _TRY:
+                success, result[key] = self._transform_candidates(data[key], arg, path)
+                if not success:
+                    return _MISSING
+
+        for path, name in plan.removed:
+            self.removed_counts[path] += 1
+            self.removed.add(name)
+        return result
+
+    def _build_shape_plan(self, shape, schema, metadata):
+        """
+        Return the _ShapePlan transforming a record of shape.
+        """
+        filtered = []
+        steps = []
+        removed = []
+        for key, value_type in zip(*shape):
+            breadcrumb = ('properties', key)
+            nested_breadcrumb = None
+            if metadata:
+                selected = singer.metadata.get(metadata, breadcrumb, 'selected')
+                inclusion = singer.metadata.get(metadata, breadcrumb, 'inclusion')
+                if inclusion != 'automatic':
+                    if (selected is False) or (inclusion == 'unsupported'):
+                        filtered.append((key, breadcrumb, self._filtered_name(breadcrumb)))
+                        continue
+                    if value_type in (dict, list):
+                        nested_breadcrumb = breadcrumb
+
+            sub_schema = self._property_schema(schema.get("properties", {}),
+                                               schema.get(SchemaKey.pattern_properties), key)
+            if sub_schema is None:
+                if nested_breadcrumb:
+                    steps.append((key, _FILTER, None, nested_breadcrumb, None))
+                removed.append(((key,), self._removed_name((key,))))
+                continue
+
+            steps.append((key, *_plan_conversion(sub_schema, value_type),
+                          nested_breadcrumb, [key]))
+
+        return _ShapePlan(filtered, steps, removed, any(step[1] is _TRY for step in steps))
@@ -1,26 +1,77 @@
-import argparse
 import collections
+import contextlib
 import datetime
 import functools
 import json
+import queue
+import random
+import re
+import threading
 import time
 from warnings import warn
 
-import dateutil.parser
+import ciso8601
 import pytz
-import backoff as backoff_module
 
-from singer.catalog import Catalog
+from singer import metrics
+from singer.logger import get_logger
+from singer.requests import giveup_on_http_4xx_except_429, retry_after_seconds
 
 DATETIME_PARSE = "%Y-%m-%dT%H:%M:%SZ"
 DATETIME_FMT = "%04Y-%m-%dT%H:%M:%S.%fZ"
 DATETIME_FMT_SAFE = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+# Shortest string the ISO-8601 fast path will accept (YYYY-MM-DD). Shorter
+# inputs such as "2018-01" are filled in from today's date by dateutil, so
+# they always take the fallback to keep that behaviour.
+ISO_8601_MIN_LENGTH = 10
+
+# Start of the strings the fast path is given: a calendar date, alone or
+# followed by a time with an hour other than 24. ciso8601 also reads ISO
+# week dates (2018-W01-1) and ordinal dates (2018-001), and reads 24:00 as
+# midnight of the next day, where dateutil raises.
+_ISO_8601_CALENDAR_DATE = re.compile(r"\d{4}-?\d{2}-?\d{2}(?:$|[Tt ](?!24))")
+
+# Longest adaptive_backoff will wait between attempts, whatever the server
+# asks for, and the most jitter it adds to a wait the server asked for.
+MAX_RETRY_WAIT = 600
+RETRY_AFTER_JITTER = 0.1
+
+# Number of datetime strings parsed by each parser. The "dateutil" count is
+# how often the ISO-8601 fast path had to fall back.
+PARSE_STATS = collections.Counter()
+
 def now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
 
+def parse_datetime(dtimestr):
+    """Parse DTIMESTR into a datetime, which may be naive.
+
+    Strict ISO-8601 calendar dates and times are parsed with ciso8601;
+    anything else falls back to dateutil, which is much slower but far more
+    lenient.
+
+    >>> parse_datetime("2018-01-01T00:00:00Z")
+    datetime.datetime(2018, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)
+    >>> parse_datetime("Jan 1 2018")
+    datetime.datetime(2018, 1, 1, 0, 0)
+    """
+    if (isinstance(dtimestr, str) and len(dtimestr) >= ISO_8601_MIN_LENGTH
+            and _ISO_8601_CALENDAR_DATE.match(dtimestr)):
+        try:
+            d_object = ciso8601.parse_datetime(dtimestr)
+            PARSE_STATS['ciso8601'] += 1
+            return d_object
+        except ValueError:
+            pass
+
+    import dateutil.parser  # pylint: disable=import-outside-toplevel
+    d_object = dateutil.parser.parse(dtimestr)
+    PARSE_STATS['dateutil'] += 1
+    return d_object
+
 def strptime_with_tz(dtime):
-    d_object = dateutil.parser.parse(dtime)
+    d_object = parse_datetime(dtime)
     if d_object.tzinfo is None:
         return d_object.replace(tzinfo=pytz.UTC)
 
@@ -58,16 +109,31 @@ def strptime(dtime):
     return datetime.datetime.strptime(dtime, DATETIME_PARSE)
 
 def strptime_to_utc(dtimestr):
-    d_object = dateutil.parser.parse(dtimestr)
+    d_object = parse_datetime(dtimestr)
     if d_object.tzinfo is None:
         return d_object.replace(tzinfo=pytz.UTC)
     else:
         return d_object.astimezone(tz=pytz.UTC)
 
+_UTC_TZINFOS = (pytz.UTC, datetime.timezone.utc)
+
+def strftime_utc(dtime):
+    """Format a UTC DTIME exactly as strftime(dtime, DATETIME_FMT) does, but
+    with a single string format instead of a strftime round trip.
+
+    >>> strftime_utc(datetime.datetime(90, 1, 1, tzinfo=pytz.UTC))
+    '0090-01-01T00:00:00.000000Z'
+    """
+    return (f"{dtime.year:04d}-{dtime.month:02d}-{dtime.day:02d}T"
+            f"{dtime.hour:02d}:{dtime.minute:02d}:{dtime.second:02d}.{dtime.microsecond:06d}Z")
+
 def strftime(dtime, format_str=DATETIME_FMT):
-    if dtime.utcoffset() != datetime.timedelta(0):
+    if dtime.tzinfo not in _UTC_TZINFOS and dtime.utcoffset() != datetime.timedelta(0):
         raise Exception("datetime must be pegged at UTC tzoneinfo")
 
+    if format_str == DATETIME_FMT:
+        return strftime_utc(dtime)
+
     dt_str = None
     try:
         dt_str = dtime.strftime(format_str)
@@ -79,22 +145,16 @@ def strftime(dtime, format_str=DATETIME_FMT):
     return dt_str
 
 def ratelimit(limit, every):
-    def limitdecorator(func):
-        times = collections.deque()
-
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            if len(times) >= limit:
-                tim0 = times.pop()
-                tim = time.time()
-                sleep_time = every - (tim - tim0)
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-
-            times.appendleft(time.time())
-            return func(*args, **kwargs)
+    """Decorates a function so it is called at most LIMIT times in any
+    EVERY seconds.
 
-        return wrapper
+    Each decorated function gets its own limiter; decorate several functions
+    with one singer.limiter.TokenBucket or SlidingWindow instead to have them
+    share a quota. Coroutine functions wait with asyncio.sleep.
+    """
+    def limitdecorator(func):
+        from singer.limiter import SlidingWindow  # pylint: disable=import-outside-toplevel
+        return SlidingWindow(limit, every)(func)
 
     return limitdecorator
 
@@ -104,6 +164,116 @@ def chunk(array, num):
         yield array[i:i + num]
 
 
+# Items a batches() reader thread may fetch ahead of the batch being built
+BATCH_READ_AHEAD = 128
+
+# How often a batches() reader thread blocked on a full queue checks
+# whether the caller has gone away.
+BATCH_POLL_INTERVAL = 0.1
+
+_TICK = object()
+_DONE = object()
+
+
+def json_size(item):
+    """Approximate size in bytes of item serialized as JSON."""
+    return len(json.dumps(item, default=str))
+
+
+def _read_with_ticks(iterable, timeout):
+    """Yield items from iterable, read on a background thread, or _TICK
+    whenever timeout() seconds pass without one. timeout() may return None
+    to wait indefinitely."""
+    items = queue.Queue(maxsize=BATCH_READ_AHEAD)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=BATCH_POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def read():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                put((item, None))
+        except BaseException as exc:  # pylint: disable=broad-except
+            put((None, exc))
+            return
+        put((_DONE, None))
+
+    threading.Thread(target=read, name="singer-batches", daemon=True).start()
+    try:
+        while True:
+            try:
+                item, exc = items.get(timeout=timeout())
+            except queue.Empty:
+                yield _TICK
+                continue
+            if exc is not None:
+                raise exc
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def batches(iterable, max_count=None, max_bytes=None, max_latency=None, sizeof=json_size):
+    """Group items from any iterable into lists, without reading it all
+    into memory first.
+
+    A batch is yielded once it holds max_count items, or before adding an
+    item would take it over max_bytes (as measured by sizeof), or
+    max_latency seconds after its first item arrived. The latency limit
+    holds even while the iterable is blocked, because it is then read on a
+    background thread. At least one limit is required.
+
+    >>> list(batches(range(5), max_count=2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(batches(["aa", "bb", "cc"], max_bytes=10))
+    [['aa', 'bb'], ['cc']]
+    """
+    if max_count is None and max_bytes is None and max_latency is None:
+        raise ValueError("batches requires max_count, max_bytes or max_latency")
+
+    batch = []
+    batch_bytes = 0
+    deadline = None
+
+    if max_latency is None:
+        items = iter(iterable)
+    else:
+        items = _read_with_ticks(
+            iterable, lambda: None if deadline is None else max(0, deadline - time.monotonic()))
+
+    for item in items:
+        if item is not _TICK:
+            size = sizeof(item) if max_bytes is not None else 0
+            if max_bytes is not None and batch and batch_bytes + size > max_bytes:
+                yield batch
+                batch, batch_bytes, deadline = [], 0, None
+            if not batch and max_latency is not None:
+                deadline = time.monotonic() + max_latency
+            batch.append(item)
+            batch_bytes += size
+            if max_count is not None and len(batch) >= max_count:
+                yield batch
+                batch, batch_bytes, deadline = [], 0, None
+                continue
+
+        if deadline is not None and time.monotonic() >= deadline:
+            yield batch
+            batch, batch_bytes, deadline = [], 0, None
+
+    if batch:
+        yield batch
+
+
 def load_json(path):
     with open(path, encoding="utf-8") as fil:
         return json.load(fil)
@@ -123,7 +293,15 @@ def update_state(state, entity, dtime):
         state[entity] = dtime
 
 
-def parse_args(required_config_keys):
+@contextlib.contextmanager
+def _timed_phase(timings, phase):
+    start = time.perf_counter()
+    yield
+    timings[phase] = time.perf_counter() - start
+    get_logger().debug("Loaded %s in %.3f seconds", phase, timings[phase])
+
+
+def parse_args(required_config_keys, lazy=False):
     '''Parse standard command-line args.
 
     Parses the command-line arguments mentioned in the SPEC and the
@@ -139,7 +317,17 @@ def parse_args(required_config_keys):
     Returns the parsed args object from argparse. For each argument that
     point to JSON files (config, state, properties), we will automatically
     load and parse the JSON file.
+
+    With lazy=True the catalog's stream schemas are parsed the first time
+    each stream's schema is used (see LazyCatalogEntry) instead of up
+    front, which is much faster for catalogs with many streams.
+
+    The seconds spent loading each file are stored in args.load_timings.
     '''
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    from singer.catalog import Catalog
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
@@ -170,20 +358,26 @@ def parse_args(required_config_keys):
         help='Runs tap in dev mode')
 
     args = parser.parse_args()
+    timings = {}
+    setattr(args, 'load_timings', timings)
     if args.config:
         setattr(args, 'config_path', args.config)
-        args.config = load_json(args.config)
+        with _timed_phase(timings, 'config'):
+            args.config = load_json(args.config)
     if args.state:
         setattr(args, 'state_path', args.state)
-        args.state = load_json(args.state)
+        with _timed_phase(timings, 'state'):
+            args.state = load_json(args.state)
     else:
         args.state = {}
     if args.properties:
         setattr(args, 'properties_path', args.properties)
-        args.properties = load_json(args.properties)
+        with _timed_phase(timings, 'properties'):
+            args.properties = load_json(args.properties)
     if args.catalog:
         setattr(args, 'catalog_path', args.catalog)
-        args.catalog = Catalog.load(args.catalog)
+        with _timed_phase(timings, 'catalog'):
+            args.catalog = Catalog.load(args.catalog, lazy=lazy)
 
     check_config(args.config, required_config_keys)
 
@@ -202,7 +396,10 @@ def backoff(exceptions, giveup):
 
     exceptions is a tuple of exception classes that are retried
     giveup is a function that accepts the exception and returns True to retry
+
+    Coroutine functions are retried with asyncio.sleep between attempts.
     """
+    import backoff as backoff_module  # pylint: disable=import-outside-toplevel
     return backoff_module.on_exception(
         backoff_module.expo,
         exceptions,
@@ -211,6 +408,75 @@ def backoff(exceptions, giveup):
         factor=2)
 
 
+def retry_after_expo(factor=2, max_value=MAX_RETRY_WAIT):
+    """A backoff wait generator that waits as long as the failed request's
+    response asked, plus up to RETRY_AFTER_JITTER of that, or a fully
+    jittered exponential backoff if it did not say."""
+    attempt = 0
+    exception = yield
+    while True:
+        wait = retry_after_seconds(getattr(exception, "response", None))
+        if wait is None:
+            wait = random.uniform(0, factor * 2 ** attempt)
+        else:
+            wait *= 1 + random.uniform(0, RETRY_AFTER_JITTER)
+        attempt += 1
+        exception = yield min(wait, max_value)
+
+
+def _log_retry_count(details, status):
+    if details["tries"] > 1:
+        metrics.log(get_logger(), metrics.Point(
+            'counter', metrics.Metric.http_retry_count, details["tries"] - 1,
+            {metrics.Tag.status: status}))
+
+
+def adaptive_backoff(exceptions, giveup=giveup_on_http_4xx_except_429, *, limiter=None,
+                     max_tries=5, factor=2, max_wait=MAX_RETRY_WAIT):
+    """Decorates a function to retry up to max_tries times, waiting as long
+    as the Retry-After or rate limit reset header of exception.response
+    asks, or backing off exponentially with jitter when there is none.
+
+    If limiter is a TokenBucket, a 429 response throttles it so every
+    caller slows down, and successful calls let it recover. Other limiters,
+    such as a SlidingWindow, keep their rate. The wait
+    before each retry is emitted as an http_retry_wait metric and the
+    number of retries a call needed as http_retry_count.
+    """
+    import backoff as backoff_module  # pylint: disable=import-outside-toplevel
+
+    def on_backoff(details):
+        response = getattr(details["exception"], "response", None)
+        status_code = getattr(response, "status_code", None)
+        if limiter is not None and status_code == 429:
+            limiter.throttle(details["wait"])
+        tags = {metrics.Tag.attempt: details["tries"]}
+        if status_code is not None:
+            tags[metrics.Tag.http_status_code] = status_code
+        metrics.log(get_logger(), metrics.Point(
+            'timer', metrics.Metric.http_retry_wait, details["wait"], tags))
+
+    def on_success(details):
+        if limiter is not None:
+            limiter.recover()
+        _log_retry_count(details, metrics.Status.succeeded)
+
+    def on_giveup(details):
+        _log_retry_count(details, metrics.Status.failed)
+
+    return backoff_module.on_exception(
+        retry_after_expo,
+        exceptions,
+        max_tries=max_tries,
+        giveup=giveup,
+        jitter=None,
+        on_backoff=on_backoff,
+        on_success=on_success,
+        on_giveup=on_giveup,
+        factor=factor,
+        max_value=max_wait)
+
+
 def exception_is_4xx(exception):
     """Returns True if exception is in the 4xx range."""
     if not hasattr(exception, "response"):
@@ -0,0 +1,45 @@
+"""An HTTP server for tests of code that makes requests."""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer():
+    '''A local HTTP server that replies with the scripted (status,
+    headers) responses in order, then with 200s.'''
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.request_times = []
+        self.client_ports = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.request_times.append(time.monotonic())
+                stub.client_ports.add(self.client_address[1])
+                status, headers = stub.responses.pop(0) if stub.responses else (200, {})
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,),
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,7 +1,16 @@
+import io
+import json
+import os
+import random
+import tempfile
+import tracemalloc
 import unittest
 
 from singer.schema import Schema
-from singer.catalog import Catalog, CatalogEntry, write_catalog
+from unittest.mock import patch
+
+from singer.catalog import (Catalog, CatalogEntry, LazyCatalogEntry, _iter_array_items,
+                            iter_streams, write_catalog)
 
 class TestWriteCatalog(unittest.TestCase):
     def test_write_empty_catalog(self):
@@ -133,6 +142,40 @@ class TestToDictAndFromDict(unittest.TestCase):
     def test_to_dict(self):
         self.assertEqual(self.dict_form, self.obj_form.to_dict())
 
+    def test_lazy_from_dict(self):
+        catalog = Catalog.from_dict(self.dict_form, lazy=True)
+        self.assertEqual(self.obj_form.streams, catalog.streams)
+        self.assertEqual(self.dict_form, catalog.to_dict())
+
+
+class TestLazyCatalogEntry(unittest.TestCase):
+
+    def test_parses_schema_on_first_use(self):
+        entry = LazyCatalogEntry(tap_stream_id='a', raw_schema={'type': 'object'})
+        with patch('singer.catalog.Schema.from_dict', wraps=Schema.from_dict) as from_dict:
+            catalog = Catalog([entry])
+            self.assertEqual('a', catalog.get_stream('a').tap_stream_id)
+            self.assertEqual(0, from_dict.call_count)
+            self.assertEqual(Schema(type='object'), entry.schema)
+            self.assertIs(entry.schema, entry.schema)
+            self.assertEqual(1, from_dict.call_count)
+
+    def test_is_selected_without_parsing_schema(self):
+        selected = LazyCatalogEntry(raw_schema={'selected': True}, metadata=[])
+        by_metadata = LazyCatalogEntry(raw_schema={}, metadata=[
+            {'metadata': {'selected': True}, 'breadcrumb': []}])
+        unselected = LazyCatalogEntry(raw_schema={}, metadata=[])
+        with patch('singer.catalog.Schema.from_dict') as from_dict:
+            self.assertTrue(selected.is_selected())
+            self.assertTrue(by_metadata.is_selected())
+            self.assertFalse(unselected.is_selected())
+        from_dict.assert_not_called()
+
+    def test_assigning_schema(self):
+        entry = LazyCatalogEntry(raw_schema={'type': 'object'})
+        entry.schema = Schema(type='string')
+        self.assertEqual(Schema(type='string'), entry.schema)
+
 
 class TestGetStream(unittest.TestCase):
     def test(self):
@@ -142,3 +185,90 @@ class TestGetStream(unittest.TestCase):
              CatalogEntry(tap_stream_id='c')])
         entry = catalog.get_stream('b')
         self.assertEqual('b', entry.tap_stream_id)
+
+
+def random_json(rng, depth=0):
+    choice = rng.randrange(8 if depth < 3 else 5)
+    if choice == 0:
+        return rng.randint(-10**6, 10**6)
+    if choice == 1:
+        return rng.random() * 10**rng.randint(-5, 5)
+    if choice == 2:
+        return "".join(rng.choice('ab"\\ \u00e9\n') for _ in range(rng.randint(0, 20)))
+    if choice == 3:
+        return rng.choice([True, False, None])
+    if choice == 4:
+        return {}
+    if choice == 5:
+        return [random_json(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+    return {f"k{i}": random_json(rng, depth + 1) for i in range(rng.randint(0, 5))}
+
+
+class TestIterStreams(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, data, indent=None):
+        path = os.path.join(self.directory.name, 'catalog.json')
+        with open(path, 'w', encoding='utf-8') as fil:
+            json.dump(data, fil, indent=indent)
+        return path
+
+    def test_matches_json_load(self):
+        rng = random.Random(49)
+        for _ in range(50):
+            items = [random_json(rng) for _ in range(rng.randint(0, 10))]
+            document = {'before': random_json(rng), 'streams': items, 'after': rng.random()}
+            for indent in (None, 2):
+                text = json.dumps(document, indent=indent)
+                with patch('singer.catalog.STREAM_READ_SIZE', rng.randint(1, 16)):
+                    self.assertEqual(items, list(_iter_array_items(io.StringIO(text), 'streams')))
+
+    def test_empty_and_missing_streams(self):
+        self.assertEqual([], list(iter_streams(self.write({'streams': []}))))
+        self.assertEqual([], list(iter_streams(self.write({}))))
+        self.assertEqual([], list(iter_streams(self.write({'other': [1, 2]}))))
+
+    def test_rejects_invalid_json(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(_iter_array_items(io.StringIO('{"streams": [{"a": 1}, {"b": }]}'), 'streams'))
+        with self.assertRaises(json.JSONDecodeError):
+            list(_iter_array_items(io.StringIO('{"streams": [1 2]}'), 'streams'))
+
+    def catalog(self, count):
+        properties = {f"column_{i}": {"type": ["null", "string"]} for i in range(50)}
+        return {'streams': [
+            {'tap_stream_id': f"stream_{i}",
+             'schema': {'type': 'object', 'properties': properties, 'selected': i == 7},
+             'metadata': []}
+            for i in range(count)]}
+
+    def test_load_selected_streams(self):
+        path = self.write(self.catalog(20))
+        catalog = Catalog.load(path, selected_only=True)
+        self.assertEqual(['stream_7'], [entry.tap_stream_id for entry in catalog.streams])
+
+        catalog = Catalog.load(path, tap_stream_ids={'stream_3', 'stream_9'}, lazy=True)
+        self.assertEqual(['stream_3', 'stream_9'],
+                         [entry.tap_stream_id for entry in catalog.streams])
+        self.assertEqual(Catalog.load(path).get_stream('stream_3').to_dict(),
+                         catalog.get_stream('stream_3').to_dict())
+
+    def test_memory_does_not_grow_with_file(self):
+        path = self.write(self.catalog(500))
+
+        tracemalloc.start()
+        Catalog.load(path, tap_stream_ids={'stream_3'})
+        _, streamed = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        Catalog.load(path)
+        _, loaded = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertLess(streamed * 20, loaded)
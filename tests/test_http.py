@@ -0,0 +1,77 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from singer.exceptions import SingerRetryableRequestError
+from singer.limiter import TokenBucket
+from tests.stub_server import StubServer
+
+try:
+    import requests
+    from singer.http import Client
+except ImportError:
+    requests = None
+
+
+def logged_points(mock):
+    return [args[1] for args, _ in mock.call_args_list]
+
+
+@unittest.skipUnless(requests, "requires requests")
+class TestClient(unittest.TestCase):
+
+    def test_reuses_connections(self):
+        with StubServer([]) as server, Client(server.url) as client, \
+             patch('singer.metrics.log'):
+            for _ in range(5):
+                client.get("/users")
+        self.assertEqual(5, len(server.request_times))
+        self.assertEqual(1, len(server.client_ports))
+
+    def test_shared_between_threads(self):
+        with StubServer([]) as server, Client(server.url, pool_size=2) as client, \
+             patch('singer.metrics.log'):
+            threads = [threading.Thread(target=lambda: [client.get("/") for _ in range(5)])
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(20, len(server.request_times))
+
+    def test_times_requests_with_status_code(self):
+        with StubServer([]) as server, Client(server.url) as client, \
+             patch('singer.metrics.log') as log:
+            client.get("/users", endpoint="users")
+        self.assertEqual({'endpoint': 'users', 'http_status_code': 200, 'status': 'succeeded'},
+                         logged_points(log)[0].tags)
+
+    def test_retries_429_honouring_retry_after(self):
+        limiter = TokenBucket(100)
+        with StubServer([(429, {'Retry-After': '0.2'}), (503, {'Retry-After': '0'})]) as server, \
+             Client(server.url, limiter=limiter) as client, \
+             patch('singer.metrics.log') as log:
+            self.assertEqual(200, client.get("/users", endpoint="users").status_code)
+
+        self.assertEqual(3, len(server.request_times))
+        self.assertGreaterEqual(server.request_times[1] - server.request_times[0], 0.2)
+        self.assertLess(limiter.rate, 100)
+        timers = [point for point in logged_points(log)
+                  if point.metric == 'http_request_duration']
+        self.assertEqual([429, 503, 200], [point.tags['http_status_code'] for point in timers])
+        self.assertEqual(['failed', 'failed', 'succeeded'],
+                         [point.tags['status'] for point in timers])
+
+    def test_gives_up_after_max_tries(self):
+        with StubServer([(500, {'Retry-After': '0'})] * 2) as server, \
+             Client(server.url, max_tries=2) as client, patch('singer.metrics.log'):
+            with self.assertRaises(SingerRetryableRequestError):
+                client.get("/")
+        self.assertEqual(2, len(server.request_times))
+
+    def test_does_not_retry_other_4xx(self):
+        with StubServer([(404, {})]) as server, Client(server.url) as client, \
+             patch('singer.metrics.log'):
+            with self.assertRaises(requests.HTTPError):
+                client.get("/")
+        self.assertEqual(1, len(server.request_times))
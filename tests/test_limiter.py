@@ -0,0 +1,306 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import singer.metrics as metrics
+from singer.limiter import FileTokenBucket, SlidingWindow, TokenBucket
+from singer.utils import backoff, ratelimit
+
+
+class FakeClock():
+    '''A clock that only moves when something sleeps on it.'''
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def make_bucket(self, rate, per=1.0, capacity=None):
+        clock = FakeClock()
+        return TokenBucket(rate, per=per, capacity=capacity,
+                           clock=clock, sleep=clock.sleep), clock
+
+    def test_bursts_up_to_capacity_then_waits_for_refill(self):
+        bucket, clock = self.make_bucket(4, per=2)
+        for _ in range(4):
+            self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0.5, bucket.acquire())
+        self.assertEqual([0.5], clock.sleeps)
+
+    def test_capacity_limits_burst(self):
+        bucket, clock = self.make_bucket(10, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual(0.1, bucket.acquire())
+        clock.now += 60
+        self.assertEqual(2, bucket.available())
+
+    def test_sustained_rate_is_exact(self):
+        bucket, clock = self.make_bucket(5, per=1, capacity=1)
+        for _ in range(101):
+            bucket.acquire()
+        self.assertAlmostEqual(20.0, clock.now)
+
+    def test_concurrent_reservations_queue_behind_each_other(self):
+        bucket, _ = self.make_bucket(2, capacity=1)
+        waits = [bucket.reserve() for _ in range(4)]
+        self.assertEqual([0.0, 0.5, 1.0, 1.5], waits)
+
+    def test_try_acquire_does_not_wait(self):
+        bucket, _ = self.make_bucket(1)
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertEqual(1, bucket.acquired)
+
+    def test_rejects_more_tokens_than_capacity(self):
+        bucket, _ = self.make_bucket(2)
+        with self.assertRaises(ValueError):
+            bucket.acquire(3)
+
+    def test_shared_between_functions(self):
+        bucket, clock = self.make_bucket(2)
+
+        @bucket
+        def first():
+            return 1
+
+        @bucket
+        def second():
+            return 2
+
+        self.assertEqual([1, 2, 1], [first(), second(), first()])
+        self.assertEqual([0.5], clock.sleeps)
+
+    def test_wait_metrics(self):
+        bucket, _ = self.make_bucket(1)
+        bucket.name = 'users'
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual(2, bucket.waits)
+        self.assertEqual(2.0, bucket.wait_seconds)
+        with patch('singer.metrics.log') as log:
+            bucket.log_metrics()
+        self.assertEqual(
+            metrics.Point('timer', 'rate_limit_wait', 2.0,
+                          {'acquired': 3, 'waits': 2, 'endpoint': 'users'}),
+            log.call_args[0][1])
+
+    def test_throttle_pauses_callers_and_halves_rate(self):
+        bucket, clock = self.make_bucket(10)
+        bucket.throttle(2.0)
+        self.assertEqual(5, bucket.rate)
+        self.assertAlmostEqual(2.0, bucket.acquire())
+        self.assertAlmostEqual(0.2, bucket.acquire())
+
+    def test_recover_restores_rate_gradually(self):
+        bucket, _ = self.make_bucket(10)
+        bucket.throttle()
+        bucket.throttle()
+        self.assertEqual(2.5, bucket.rate)
+        bucket.recover()
+        self.assertAlmostEqual(2.6, bucket.rate)
+        for _ in range(100):
+            bucket.recover()
+        self.assertEqual(10, bucket.rate)
+
+    def test_threads_do_not_over_admit(self):
+        bucket = TokenBucket(50, per=1, capacity=5)
+        calls = []
+
+        def worker():
+            for _ in range(5):
+                bucket.acquire()
+                calls.append(time.monotonic())
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=worker) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 5 tokens up front, the other 25 at 50 per second
+        self.assertEqual(30, len(calls))
+        self.assertGreaterEqual(max(calls) - start, 0.45)
+        self.assertEqual(30, bucket.acquired)
+
+
+def _acquire_from_file_bucket(path, count, results):
+    bucket = FileTokenBucket(path, 50, per=1, capacity=5)
+    for _ in range(count):
+        bucket.acquire()
+        results.put(time.time())
+
+
+class TestFileTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def make_bucket(self, clock):
+        return FileTokenBucket(self.path, 2, capacity=2, clock=clock, sleep=clock.sleep)
+
+    def test_buckets_on_one_file_share_tokens(self):
+        clock = FakeClock()
+        first, second = self.make_bucket(clock), self.make_bucket(clock)
+        self.assertEqual(0, first.acquire())
+        self.assertEqual(0, second.acquire())
+        self.assertEqual(0.5, first.acquire())
+        self.assertFalse(second.try_acquire())
+        clock.now += 0.5
+        self.assertEqual(1, second.available())
+
+    def test_processes_split_one_budget(self):
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_acquire_from_file_bucket,
+                                             args=(self.path, 10, results))
+                     for _ in range(4)]
+        start = time.time()
+        for process in processes:
+            process.start()
+        times = sorted(results.get(timeout=10) for _ in range(40))
+        for process in processes:
+            process.join()
+
+        # 5 tokens up front, the other 35 at 50 per second across all processes
+        self.assertGreaterEqual(times[-1] - start, 0.65)
+        for i in range(len(times) - 10):
+            self.assertGreaterEqual(times[i + 10] - times[i], 0.09)
+
+
+class TestSlidingWindow(unittest.TestCase):
+
+    def test_never_admits_more_than_limit_per_window(self):
+        clock = FakeClock()
+        window = SlidingWindow(10, 60, clock=clock, sleep=clock.sleep)
+        starts = []
+        for _ in range(40):
+            window.acquire()
+            starts.append(clock.now)
+            clock.now += 1
+        for i in range(len(starts) - 10):
+            self.assertGreaterEqual(starts[i + 10] - starts[i], 60)
+        # 10 calls up front, then 10 more once each of those is 60s old
+        self.assertEqual(list(range(10)), starts[:10])
+        self.assertEqual(60, starts[10])
+
+    def test_concurrent_reservations_queue_behind_each_other(self):
+        clock = FakeClock()
+        window = SlidingWindow(2, 1, clock=clock, sleep=clock.sleep)
+        self.assertEqual([0, 0, 1, 1, 2], [window.reserve() for _ in range(5)])
+
+    def test_rejects_more_tokens_than_limit(self):
+        window = SlidingWindow(2, 1)
+        with self.assertRaises(ValueError):
+            window.acquire(3)
+
+
+class TestRatelimit(unittest.TestCase):
+
+    def test_wraps_function(self):
+        @ratelimit(100, 1)
+        def double(value):
+            return value * 2
+
+        self.assertEqual(4, double(2))
+        self.assertEqual('double', double.__name__)
+
+    def test_limits_calls(self):
+        @ratelimit(2, 0.2)
+        def noop():
+            pass
+
+        start = time.monotonic()
+        for _ in range(4):
+            noop()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_at_most_limit_calls_per_window(self):
+        calls = []
+
+        @ratelimit(3, 0.2)
+        def record():
+            calls.append(time.monotonic())
+
+        for _ in range(7):
+            record()
+        for i in range(len(calls) - 3):
+            self.assertGreaterEqual(calls[i + 3] - calls[i], 0.19)
+
+
+class TestAsyncRateLimiting(unittest.TestCase):
+
+    def test_coroutines_share_bucket_without_blocking_loop(self):
+        bucket = TokenBucket(20, per=1, capacity=2)
+        ticks = []
+
+        @bucket
+        async def fetch(page):
+            return page
+
+        async def ticker():
+            for _ in range(5):
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.02)
+
+        async def main():
+            ticking = asyncio.ensure_future(ticker())
+            pages = await asyncio.gather(*[fetch(page) for page in range(6)])
+            await ticking
+            return pages
+
+        start = time.monotonic()
+        pages = asyncio.run(main())
+
+        self.assertEqual(list(range(6)), pages)
+        # 2 pages up front, the other 4 at 20 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        self.assertEqual(5, len(ticks))
+        self.assertLess(ticks[1] - ticks[0], 0.1)
+
+    def test_ratelimit_decorates_coroutine_functions(self):
+        @ratelimit(2, 0.2)
+        async def double(value):
+            return value * 2
+
+        async def main():
+            return [await double(i) for i in range(4)]
+
+        start = time.monotonic()
+        self.assertEqual([0, 2, 4, 6], asyncio.run(main()))
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_backoff_retries_coroutine_functions(self):
+        attempts = []
+
+        @backoff((ValueError,), giveup=lambda exc: False)
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise ValueError("try again")
+            return "ok"
+
+        with patch('backoff._async.asyncio.sleep') as sleep:
+            self.assertEqual("ok", asyncio.run(flaky()))
+        self.assertEqual(2, len(attempts))
+        sleep.assert_awaited_once()
@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import singer.metrics as metrics
+from singer.pagination import prefetch_pages, prefetch_records
+
+# Long enough for a fetching thread to notice the caller stopped
+POLL_WAIT = 0.25
+
+
+class Pages():
+    '''fetch_page over count pages of three records, with cursors 0..count-1.'''
+
+    def __init__(self, count, delay=0.0, fail_at=None):
+        self.count = count
+        self.delay = delay
+        self.fail_at = fail_at
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def __call__(self, cursor):
+        cursor = cursor or 0
+        time.sleep(self.delay)
+        if cursor == self.fail_at:
+            raise RuntimeError(f"page {cursor} failed")
+        with self.lock:
+            self.fetched.append(cursor)
+        next_cursor = cursor + 1 if cursor + 1 < self.count else None
+        return [cursor * 3 + i for i in range(3)], next_cursor
+
+
+class TestPrefetchPages(unittest.TestCase):
+
+    def test_delivers_pages_in_order(self):
+        pages = list(prefetch_pages(Pages(10)))
+        self.assertEqual([[i * 3, i * 3 + 1, i * 3 + 2] for i in range(10)], pages)
+
+    def test_starts_from_cursor(self):
+        self.assertEqual([[6, 7, 8], [9, 10, 11]], list(prefetch_pages(Pages(4), cursor=2)))
+
+    def test_overlaps_fetching_with_processing(self):
+        start = time.monotonic()
+        for _ in prefetch_pages(Pages(5, delay=0.05)):
+            time.sleep(0.05)
+        # Sequentially this would take 0.5s
+        self.assertLess(time.monotonic() - start, 0.4)
+
+    def test_fetches_at_most_prefetch_pages_ahead(self):
+        fetch_page = Pages(20)
+        pages = prefetch_pages(fetch_page, prefetch=2)
+        next(pages)
+        time.sleep(0.1)
+        # One page delivered, two queued and one waiting to be queued
+        self.assertLessEqual(len(fetch_page.fetched), 4)
+        pages.close()
+
+    def test_raises_fetch_errors_after_earlier_pages(self):
+        delivered = []
+        with self.assertRaisesRegex(RuntimeError, "page 3 failed"):
+            for page in prefetch_pages(Pages(10, fail_at=3)):
+                delivered.append(page[0])
+        self.assertEqual([0, 3, 6], delivered)
+
+    def test_stops_fetching_when_caller_stops(self):
+        fetch_page = Pages(1000)
+        for _ in prefetch_pages(fetch_page, prefetch=1):
+            break
+        time.sleep(POLL_WAIT)
+        fetched = len(fetch_page.fetched)
+        time.sleep(POLL_WAIT)
+        self.assertEqual(fetched, len(fetch_page.fetched))
+        self.assertLessEqual(fetched, 3)
+
+    def test_rejects_zero_prefetch(self):
+        with self.assertRaises(ValueError):
+            next(prefetch_pages(Pages(1), prefetch=0))
+
+
+class TestPrefetchRecords(unittest.TestCase):
+
+    def test_counts_records(self):
+        with patch('singer.metrics.log') as log:
+            with metrics.record_counter('users') as counter:
+                records = list(prefetch_records(Pages(4), counter=counter))
+        self.assertEqual(list(range(12)), records)
+        self.assertEqual(metrics.Point('counter', 'record_count', 12, {'endpoint': 'users'}),
+                         log.call_args[0][1])
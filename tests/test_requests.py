@@ -0,0 +1,49 @@
+import unittest
+
+from singer.requests import giveup_on_http_4xx_except_429, retry_after_seconds
+
+
+class Response():
+    def __init__(self, status_code=429, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class HTTPError(Exception):
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+class TestGiveup(unittest.TestCase):
+
+    def test_retries_429_and_5xx(self):
+        self.assertFalse(giveup_on_http_4xx_except_429(HTTPError(Response(429))))
+        self.assertFalse(giveup_on_http_4xx_except_429(HTTPError(Response(503))))
+        self.assertTrue(giveup_on_http_4xx_except_429(HTTPError(Response(404))))
+
+
+class TestRetryAfterSeconds(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(2.5, retry_after_seconds(Response(headers={'retry-after': '2.5'})))
+
+    def test_http_date(self):
+        response = Response(headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(10.0, retry_after_seconds(response, now=1445412470))
+
+    def test_reset_in_seconds(self):
+        self.assertEqual(30.0, retry_after_seconds(Response(headers={'RateLimit-Reset': '30'})))
+
+    def test_reset_as_epoch(self):
+        response = Response(headers={'X-RateLimit-Reset': '1445412500'})
+        self.assertEqual(30.0, retry_after_seconds(response, now=1445412470))
+
+    def test_never_negative(self):
+        response = Response(headers={'X-RateLimit-Reset': '1445412400'})
+        self.assertEqual(0.0, retry_after_seconds(response, now=1445412470))
+
+    def test_missing_or_unparseable(self):
+        self.assertIsNone(retry_after_seconds(None))
+        self.assertIsNone(retry_after_seconds(Response()))
+        self.assertIsNone(retry_after_seconds(Response(headers={'Retry-After': 'soon'})))
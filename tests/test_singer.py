@@ -3,6 +3,10 @@ import unittest
 from unittest.mock import patch
 import datetime
 import dateutil
+import importlib
+import json
+import subprocess
+import sys
 from decimal import Decimal
 
 
@@ -206,5 +210,40 @@ class TestParsingNumbers(unittest.TestCase):
         mock_stdout.write.assert_called_once_with(expected_output)
         mock_stdout.flush.assert_called_once()
 
+class TestLazyImports(unittest.TestCase):
+
+    def test_import_defers_heavy_dependencies(self):
+        probe = "import json, sys, singer; print(json.dumps(sorted(sys.modules)))"
+        output = subprocess.run([sys.executable, '-c', probe], check=True,
+                                capture_output=True, text=True).stdout
+        modules = set(json.loads(output))
+        for name in ['asyncio', 'backoff', 'dateutil.parser', 'jsonschema',
+                     'simplejson', 'singer.catalog', 'singer.messages']:
+            self.assertNotIn(name, modules)
+
+    def test_lazy_attributes_resolve(self):
+        for name, (module, attribute) in singer._LAZY_ATTRIBUTES.items():
+            self.assertIs(getattr(importlib.import_module(module), attribute),
+                          getattr(singer, name))
+            self.assertIn(name, singer.__all__)
+        self.assertIs(singer.set_bookmark, singer.write_bookmark)
+        self.assertIn('Catalog', dir(singer))
+
+    def test_submodules_are_attributes(self):
+        self.assertEqual('singer.catalog', singer.catalog.__name__)
+        self.assertTrue(callable(singer.transform))
+
+    def test_star_import_includes_submodules(self):
+        namespace = {}
+        exec('from singer import *', namespace)  # pylint: disable=exec-used
+        for name in ['bookmarks', 'catalog', 'exceptions', 'messages', 'schema', 'state']:
+            self.assertEqual('singer.' + name, namespace[name].__name__)
+        self.assertNotIn('transform_shapes', namespace)
+
+    def test_unknown_attribute(self):
+        with self.assertRaises(AttributeError):
+            singer.no_such_thing  # pylint: disable=pointless-statement
+
+
 if __name__ == '__main__':
     unittest.main()
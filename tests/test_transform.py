@@ -1,11 +1,23 @@
+import copy
 import io
+import random
 import sys
+import threading
 import unittest
 import decimal
+from unittest.mock import patch
 import simplejson as json
 import singer.messages as messages
+import singer.metrics
+from singer.transform import _RESOLVERS, _cached_transformer
+from singer.schema import Schema
 from singer import transform
 from singer.transform import *
+from singer.transform_columnar import _numpy, _vectorized_column
+from singer.transform_common import _to_integer, _to_number
+from singer.transform_pool import PENDING_CHUNKS_PER_PROCESS, TransformPool
+from singer.transform_profile import ProfilingTransformer
+from singer.transform_shapes import RECORD_SHAPES_WARMUP
 
 class TestTransform(unittest.TestCase):
     def test_integer_transform(self):
@@ -89,6 +101,36 @@ class TestTransform(unittest.TestCase):
         self.assertEqual(transformed_string_datetime, transform(string_datetime, schema))
         self.assertIsNone(transform(None, schema))
 
+    def test_anyof_failed_branches_record_no_errors(self):
+        schema = {'anyOf': [{'type': 'object',
+                             'properties': {'a': {'type': 'integer'},
+                                            'b': {'type': 'integer'}}},
+                            {'type': 'object',
+                             'properties': {'a': {'type': 'string'}}}]}
+        trans = Transformer()
+        success, data = trans.transform_recur({'a': 'x', 'b': 'y'}, schema, [])
+        self.assertTrue(success)
+        self.assertEqual({'a': 'x'}, data)
+        self.assertListEqual([], trans.errors)
+
+    def test_anyof_records_single_error_when_all_branches_fail(self):
+        schema = {'type': 'object',
+                  'properties': {'foo': {'anyOf': [{'type': 'object',
+                                                    'properties': {'a': {'type': 'integer'}}},
+                                                   {'type': 'integer'}]}}}
+        trans = Transformer()
+        success, _ = trans.transform_recur({'foo': {'a': 'x'}}, schema, [])
+        self.assertFalse(success)
+        self.assertListEqual([[], ['foo']], sorted(e.path for e in trans.errors))
+        self.assertIn('anyOf', trans.errors[0].schema)
+
+    def test_nested_anyof(self):
+        inner = {'anyOf': [{'type': 'integer'}, {'type': 'boolean'}]}
+        schema = {'anyOf': [{'type': 'array', 'items': inner},
+                            {'type': 'string'}]}
+        self.assertEqual([1, True], transform(['1', True], schema))
+        self.assertEqual('x', transform('x', schema))
+
     def test_error_path(self):
         schema = {"type": "object",
                   "properties": {"foo": {"type": "integer"},
@@ -238,6 +280,42 @@ class TestTransform(unittest.TestCase):
         self.assertSetEqual(set(["bad_property"]), trans.removed)
         self.assertListEqual([], trans.errors)
 
+    def test_removed_and_filtered_counts(self):
+        schema = {"type": "object",
+                  "properties": {"a": {"type": "integer"},
+                                 "b": {"type": "array",
+                                       "items": {"type": "object",
+                                                 "properties": {"c": {"type": "integer"}}}}}}
+        mdata = {('properties', 'b', 'items', 'properties', 'd'): {'selected': False}}
+        trans = Transformer()
+        for _ in range(3):
+            trans.transform({"a": 1, "x": 2, "b": [{"c": 1, "d": 2, "y": 3}]}, schema, mdata)
+        self.assertEqual({("x",): 3, ("b", 0, "y"): 3}, trans.removed_counts)
+        self.assertEqual({('properties', 'b', 'items', 'properties', 'd'): 3},
+                         trans.filtered_counts)
+        self.assertSetEqual({"x", "b.0.y"}, trans.removed)
+        self.assertSetEqual({"b[].d"}, trans.filtered)
+        with self.assertLogs(level='DEBUG') as logs:
+            trans.log_warning()
+        self.assertIn("DEBUG:root:Removed path counts: {'b.0.y': 3, 'x': 3}",
+                      sorted(logs.output))
+
+    def test_removed_and_filtered_are_plain_sets(self):
+        schema = {"type": "object", "properties": {"a": {"type": "integer"}}}
+        mdata = {('properties', 'hidden'): {'selected': False}}
+        for shape_cache in (False, True):
+            trans = Transformer(shape_cache=shape_cache)
+            trans.transform({"a": 1, "x": 2, "hidden": 3}, schema, mdata)
+            trans.removed.clear()
+            trans.filtered = set()
+            trans.removed.add("custom")
+            trans.transform({"a": 1, "x": 2, "hidden": 3}, schema, mdata)
+            self.assertSetEqual({"custom", "x"}, trans.removed)
+            self.assertSetEqual({"hidden"}, trans.filtered)
+            trans.removed = set()
+            trans.transform({"a": 1, "y": 2}, schema, mdata)
+            self.assertSetEqual({"y"}, trans.removed)
+
     def test_unix_seconds_to_datetime(self):
         self.assertEqual(unix_seconds_to_datetime(0), '1970-01-01T00:00:00.000000Z')
         self.assertEqual(unix_seconds_to_datetime(1502722441), '2017-08-14T14:54:01.000000Z')
@@ -322,6 +400,585 @@ class TestTransform(unittest.TestCase):
         with self.assertRaises(SchemaMismatch):
             self.assertEqual({'percentage':None}, transform(badnull, schema))
 
+    def test_decimal_to_string_matches_decimal_round_trip(self):
+        rng = random.Random(0)
+        values = ["0", "-0", "00", "01", "0.0", "0.000001", "0.0000001", "0.0000010",
+                  "1.", ".5", "+1", "1_000", " 1", "\u0661\u0662", "-12.3400", True,
+                  2**80, -2**80]
+        for _ in range(5000):
+            value = rng.choice(["-", ""]) + rng.choice(["0", ""])
+            value += "".join(rng.choice("0123456789") for _ in range(rng.randint(0, 5)))
+            if rng.random() < 0.6:
+                value += "." + "".join(rng.choice("0000123456789") for _ in range(rng.randint(0, 9)))
+            values.append(value)
+        for value in values:
+            try:
+                expected = str(decimal.Decimal(str(value)))
+            except decimal.InvalidOperation:
+                expected = decimal.InvalidOperation
+            try:
+                actual = decimal_to_string(value)
+            except decimal.InvalidOperation:
+                actual = decimal.InvalidOperation
+            self.assertEqual(expected, actual, value)
+
+class TestInPlaceTransform(unittest.TestCase):
+    schema = {"type": "object",
+              "properties": {"id": {"type": "integer"},
+                             "name": {"type": ["null", "string"]},
+                             "addrs": {"type": ["null", "array"],
+                                       "items": {"type": "object",
+                                                 "properties": {"amount": {"type": "integer"}}}}}}
+
+    def test_matches_copying_transform(self):
+        data = {"id": "1", "name": "a", "extra": 1,
+                "addrs": [{"amount": "123"}, {"amount": 456, "other": "x"}]}
+        expected = transform(copy.deepcopy(data), self.schema)
+        self.assertEqual(expected, transform(data, self.schema, in_place=True))
+
+    def test_mutates_input(self):
+        addrs = [{"amount": "123", "other": "x"}]
+        data = {"id": "1", "addrs": addrs}
+        trans = Transformer(in_place=True)
+        result = trans.transform(data, self.schema)
+        self.assertIs(data, result)
+        self.assertIs(addrs, result["addrs"])
+        self.assertEqual({"id": 1, "addrs": [{"amount": 123}]}, data)
+        self.assertSetEqual({"addrs.0.other"}, trans.removed)
+
+    def test_stops_at_first_failure(self):
+        data = {"id": "not an integer",
+                "addrs": [{"amount": "also not an integer"}]}
+        trans = Transformer(in_place=True)
+        success, _ = trans.transform_recur(data, self.schema, [])
+        self.assertFalse(success)
+        self.assertEqual(2, len(trans.errors))
+
+    def test_does_not_mutate_when_another_type_may_apply(self):
+        schema = {"type": ["object", "string"],
+                  "properties": {"a": {"type": "integer"},
+                                 "b": {"type": "integer"}}}
+        data = {"a": "1", "b": "x"}
+        self.assertEqual(str({"a": "1", "b": "x"}), transform(data, schema, in_place=True))
+        self.assertEqual({"a": "1", "b": "x"}, data)
+
+    def test_does_not_mutate_failed_anyof_branch(self):
+        schema = {"anyOf": [{"type": "object",
+                             "properties": {"a": {"type": "integer"},
+                                            "b": {"type": "integer"}}},
+                            {"type": "object",
+                             "properties": {"a": {"type": "string"},
+                                            "b": {"type": "string"}}}]}
+        data = {"a": "1,000", "b": "x"}
+        self.assertEqual({"a": "1,000", "b": "x"}, transform(data, schema, in_place=True))
+
+
+def _upper_hook(data, typ, schema):
+    if typ == "string" and isinstance(data, str):
+        return data.upper()
+    return data
+
+
+class TestTransformPool(unittest.TestCase):
+    schema = {"type": "object",
+              "properties": {"id": {"type": "integer"},
+                             "name": {"type": "string"},
+                             "hidden": {"type": "string"},
+                             "updated_at": {"type": "string", "format": "date-time"}}}
+    mdata = {('properties', 'hidden'): {'selected': False}}
+
+    def records(self, count):
+        for i in range(count):
+            yield {"id": str(i), "name": "n{}".format(i), "hidden": "h",
+                   "updated_at": "2017-01-01", "extra": i}
+
+    def test_matches_sequential_transform_in_order(self):
+        expected = [transform(r, self.schema, metadata=self.mdata) for r in self.records(25)]
+        with Transformer() as trans:
+            with TransformPool(trans, self.schema, self.mdata, processes=2, chunk_size=4) as pool:
+                self.assertEqual(expected, list(pool.transform(self.records(25))))
+        self.assertSetEqual({"extra"}, trans.removed)
+        self.assertSetEqual({"hidden"}, trans.filtered)
+
+    def test_uses_pre_hook(self):
+        trans = Transformer(pre_hook=_upper_hook)
+        with TransformPool(trans, self.schema, processes=1) as pool:
+            self.assertEqual(["N0", "N1"], [r["name"] for r in pool.transform(self.records(2))])
+
+    def test_raises_schema_mismatch(self):
+        records = [{"id": "1"}, {"id": "not an integer"}]
+        trans = Transformer()
+        with self.assertRaises(SchemaMismatch):
+            with TransformPool(trans, self.schema, processes=1, chunk_size=1) as pool:
+                list(pool.transform(records))
+        self.assertListEqual([[], ["id"]], sorted(e.path for e in trans.errors))
+
+    def test_yields_records_before_failing_one(self):
+        records = [{"id": "1"}, {"id": "2"}, {"id": "not an integer"}, {"id": "4"}]
+        results = []
+        with self.assertRaises(SchemaMismatch):
+            with TransformPool(Transformer(), self.schema, processes=1, chunk_size=10) as pool:
+                for record in pool.transform(records):
+                    results.append(record)
+        self.assertEqual([{"id": 1}, {"id": 2}], results)
+
+    def test_reads_records_as_they_are_needed(self):
+        read = []
+        def records():
+            for i in range(200000):
+                read.append(i)
+                yield {"id": i}
+        with TransformPool(Transformer(), self.schema, processes=1, chunk_size=10) as pool:
+            transformed = pool.transform(records())
+            self.assertEqual({"id": 0}, next(transformed))
+            self.assertLessEqual(len(read), 10 * (PENDING_CHUNKS_PER_PROCESS + 1))
+            transformed.close()
+
+
+class TestTransformColumnar(unittest.TestCase):
+    schema = {"type": ["null", "object"],
+              "properties": {"id": {"type": "integer"},
+                             "count": {"type": ["null", "integer"]},
+                             "price": {"type": ["null", "number"]},
+                             "name": {"type": ["null", "string"]},
+                             "active": {"type": ["null", "boolean"]},
+                             "amount": {"type": ["null", "string"], "format": "singer.decimal"},
+                             "updated_at": {"type": ["null", "string"], "format": "date-time"},
+                             "tags": {"type": "array", "items": {"type": "integer"}},
+                             "either": {"anyOf": [{"type": "integer"}, {"type": "string"}]},
+                             "untyped": {}}}
+
+    def records(self):
+        return [{"id": 1, "count": "1,234", "price": 1.5, "name": "a", "active": "false",
+                 "amount": 1.10, "updated_at": "2017-01-01", "tags": ["1", 2],
+                 "either": "3", "untyped": {"x": 1}, "extra": True},
+                {"id": "2", "count": "", "price": "2", "name": None, "active": None,
+                 "amount": "3.300", "updated_at": None, "either": "x"},
+                {"count": None, "price": True, "name": 3, "active": 1,
+                 "amount": decimal.Decimal("sNaN"), "updated_at": ""}]
+
+    def test_matches_per_record_transform(self):
+        expected = [transform(r, self.schema) for r in self.records()]
+        trans = Transformer()
+        result = trans.transform_columnar(self.records(), self.schema)
+        self.assertEqual(expected, result)
+        self.assertEqual([list(r) for r in expected], [list(r) for r in result])
+        self.assertSetEqual({"extra"}, trans.removed)
+
+    def test_numeric_columns(self):
+        records = [{"id": i, "price": i} for i in range(10)] + [{"id": True, "price": 2**70}]
+        expected = [transform(r, self.schema) for r in records]
+        result = Transformer().transform_columnar(records, self.schema)
+        self.assertEqual(expected, result)
+        self.assertEqual([type(v) for r in expected for v in r.values()],
+                         [type(v) for r in result for v in r.values()])
+
+    def test_nested_numeric_column_fails(self):
+        with self.assertRaises(SchemaMismatch):
+            Transformer().transform_columnar([{"id": [1, 2]}, {"id": [3, 4]}], self.schema)
+
+    def test_filters_by_metadata(self):
+        mdata = {('properties', 'name'): {'selected': False}}
+        trans = Transformer()
+        result = trans.transform_columnar([{"id": "1", "name": "a"}], self.schema, mdata)
+        self.assertEqual([{"id": 1}], result)
+        self.assertSetEqual({"name"}, trans.filtered)
+
+    def test_raises_for_first_failing_record(self):
+        records = [{"id": 1}, {"id": 2, "price": "nope"}, {"id": "nope"}]
+        trans = Transformer()
+        with self.assertRaises(SchemaMismatch):
+            trans.transform_columnar(records, self.schema)
+        self.assertListEqual([[], ["price"]], sorted(e.path for e in trans.errors))
+
+    def test_failure_counts_removed_paths_up_to_failing_record(self):
+        records = [{"id": 1, "extra": 1}, {"id": "nope", "extra": 1},
+                   {"id": 3, "extra": 1, "more": {"x": 1}}]
+        trans = Transformer()
+        with self.assertRaises(SchemaMismatch):
+            trans.transform_columnar(records, self.schema)
+        self.assertEqual({("extra",): 2}, trans.removed_counts)
+        self.assertSetEqual({"extra"}, trans.removed)
+
+    def test_failed_column_always_raises(self):
+        def fail(value):
+            raise ValueError(value)
+
+        trans = Transformer()
+        with patch.object(trans, "_column_converter", return_value=fail):
+            with self.assertRaises(SchemaMismatch):
+                trans.transform_columnar([{"id": 1}, {"id": 2}], self.schema)
+
+    @unittest.skipUnless(_numpy(), "requires numpy")
+    def test_vectorized_columns(self):
+        columns = {"int": [1, -2, 3],
+                   "uint64": [2**63, 2**64 - 1],
+                   "bool": [True, False],
+                   "bool_and_int": [True, 2],
+                   "int_and_float": [1, 2.5],
+                   "beyond_uint64": [-1, 2**64 - 1]}
+        for name, column in columns.items():
+            for convert in (_to_integer, _to_number):
+                with self.subTest(column=name, convert=convert.__name__):
+                    expected = [convert(value) for value in column]
+                    result = _vectorized_column(column, convert)
+                    if result is not None:
+                        self.assertEqual(expected, result)
+                        self.assertEqual([type(v) for v in expected], [type(v) for v in result])
+
+        self.assertIsNotNone(_vectorized_column(columns["uint64"], _to_integer))
+        self.assertIsNotNone(_vectorized_column(columns["bool"], _to_integer))
+        self.assertIsNone(_vectorized_column(columns["int_and_float"], _to_integer))
+        for mixed in ([1, "2"], [1, None], [1, 2**70], [[1], [2]]):
+            self.assertIsNone(_vectorized_column(mixed, _to_integer))
+
+        records = [{"id": value, "price": value} for value in [1, True, 2**63]]
+        self.assertEqual([transform(r, self.schema) for r in records],
+                         Transformer().transform_columnar(records, self.schema))
+
+    def test_falls_back_for_non_object_schemas(self):
+        schema = {"type": "array", "items": {"type": "integer"}}
+        self.assertEqual([[1], [2]], Transformer().transform_columnar([["1"], ["2"]], schema))
+
+
+class TestShapeCache(unittest.TestCase):
+    schema = {"type": ["null", "object"],
+              "properties": {"id": {"type": "integer"},
+                             "name": {"type": ["null", "string"]},
+                             "active": {"type": "boolean"},
+                             "amount": {"type": ["null", "string"], "format": "singer.decimal"},
+                             "updated_at": {"type": ["null", "string"], "format": "date-time"},
+                             "either": {"anyOf": [{"type": "integer"}, {"type": "string"}]},
+                             "nested": {"type": ["null", "object"],
+                                        "properties": {"a": {"type": "integer"},
+                                                       "b": {"type": "integer"}}},
+                             "hidden": {"type": "string"},
+                             "untyped": {}},
+              "patternProperties": {"^x_": {"type": "integer"}}}
+    mdata = {('properties', 'hidden'): {'selected': False},
+             ('properties', 'nested', 'properties', 'b'): {'selected': False}}
+
+    def records(self):
+        return [{"id": 1, "name": "a", "active": "false", "amount": 1.1,
+                 "updated_at": "2017-01-01", "either": "3", "nested": {"a": "1", "b": 2},
+                 "hidden": "h", "untyped": [1], "x_1": "4", "extra": 1},
+                {"id": 2, "name": None, "active": None, "amount": "2.50",
+                 "updated_at": None, "either": "y", "nested": None,
+                 "hidden": "h", "untyped": None, "x_1": 5, "extra": 2},
+                {"id": "3", "name": 3, "active": 1, "amount": None,
+                 "updated_at": "", "either": 4, "nested": {"a": 2},
+                 "hidden": "h", "untyped": "u", "x_1": "6", "extra": 3}]
+
+    def assert_same_as_uncached(self, records, metadata=None):
+        plain = Transformer()
+        expected = [plain.transform(r, self.schema, metadata)
+                    for r in copy.deepcopy(records)]
+        cached = Transformer(shape_cache=True)
+        result = [cached.transform(r, self.schema, metadata)
+                  for r in copy.deepcopy(records)]
+        self.assertEqual(expected, result)
+        self.assertEqual([list(r) for r in expected], [list(r) for r in result])
+        self.assertEqual(plain.removed_counts, cached.removed_counts)
+        self.assertEqual(plain.filtered_counts, cached.filtered_counts)
+        return cached
+
+    def test_matches_uncached_transform(self):
+        cached = self.assert_same_as_uncached(self.records() * 3)
+        self.assertEqual(3, len(cached._shapes))
+
+    def test_matches_uncached_transform_with_metadata(self):
+        cached = self.assert_same_as_uncached(self.records() * 3, self.mdata)
+        self.assertSetEqual({"hidden", "nested.b"}, cached.filtered)
+
+    def test_value_dependent_conversions_are_not_cached(self):
+        schema = {"type": "object",
+                  "properties": {"v": {"anyOf": [{"type": "integer"}, {"type": "string"}]}}}
+        trans = Transformer(shape_cache=True)
+        self.assertEqual({"v": "a"}, trans.transform({"v": "a"}, schema))
+        self.assertEqual({"v": 1}, trans.transform({"v": "1"}, schema))
+
+    def test_raises_with_uncached_errors(self):
+        trans = Transformer(shape_cache=True)
+        trans.transform({"id": 1}, self.schema)
+        with self.assertRaises(SchemaMismatch):
+            trans.transform({"id": "nope"}, self.schema)
+        self.assertListEqual([[], ["id"]], sorted(e.path for e in trans.errors))
+
+    def test_out_of_range_values_raise_schema_mismatch(self):
+        schema = {"type": "object",
+                  "properties": {"extra": {"type": "integer"},
+                                 "n": {"type": ["null", "number"]}}}
+        trans = Transformer(shape_cache=True)
+        trans.transform({"n": 1, "x": 1}, schema)
+        with self.assertRaises(SchemaMismatch):
+            trans.transform({"n": 10**400, "x": 1}, schema)
+        self.assertListEqual([[], ["n"]], sorted(e.path for e in trans.errors))
+        self.assertEqual(2, trans.removed_counts[("x",)])
+
+        schema = {"type": "object", "properties": {"s": {"type": "string"}}}
+        with self.assertRaises(SchemaMismatch):
+            Transformer(shape_cache=True).transform({"s": 10**5000}, schema)
+
+    def test_nested_failure_matches_uncached_errors(self):
+        schema = {"type": "object",
+                  "properties": {"d": {"type": "object",
+                                       "properties": {"e": {"type": "integer"}}},
+                                 "a": {"anyOf": [{"type": "object",
+                                                  "properties": {"x": {"type": "integer"}}},
+                                                 {"type": "object",
+                                                  "properties": {"y": {"type": "integer"}}}]}}}
+        record = {"extra": 1, "d": {"e": "w", "f": 1}, "a": {"x": "z"}}
+        plain, cached = Transformer(), Transformer(shape_cache=True)
+        messages = []
+        for trans in (plain, cached):
+            with self.assertRaises(SchemaMismatch) as context:
+                trans.transform(copy.deepcopy(record), schema)
+            messages.append(str(context.exception))
+        self.assertEqual(messages[0], messages[1])
+        self.assertEqual(1, messages[1].count("\td.e: "))
+        self.assertEqual(plain.removed_counts, cached.removed_counts)
+        self.assertEqual(1, cached.removed_counts[("extra",)])
+
+    def test_stops_caching_when_shapes_rarely_repeat(self):
+        schema = {"type": "object", "properties": {}, "patternProperties": {".*": {}}}
+        trans = Transformer(shape_cache=True)
+        for i in range(RECORD_SHAPES_WARMUP + 1):
+            self.assertEqual({str(i): i}, trans.transform({str(i): i}, schema))
+        self.assertFalse(trans._shapes_enabled)
+        self.assertEqual({}, trans._shapes)
+
+    def test_cache_resets_for_new_schema(self):
+        trans = Transformer(shape_cache=True)
+        trans.transform({"id": "1"}, self.schema)
+        schema = {"type": "object", "properties": {"id": {"type": "string"}}}
+        self.assertEqual({"id": "1"}, trans.transform({"id": "1"}, schema))
+
+
+def _cents_to_dollars(value):
+    return value / 100
+
+
+class TestRecordHooks(unittest.TestCase):
+    schema = {"type": "object",
+              "properties": {"id": {"type": "integer"},
+                             "total": {"type": "number"},
+                             "lines": {"type": "array",
+                                       "items": {"type": "object",
+                                                 "properties": {"amount": {"type": "number"}}}}}}
+
+    def test_record_hook_called_once_per_record(self):
+        calls = []
+        def hook(record):
+            calls.append(record)
+            return dict(record, id=int(record["id"]) * 2)
+        trans = Transformer(record_hook=hook)
+        self.assertEqual({"id": 4}, trans.transform({"id": "2"}, self.schema))
+        self.assertEqual(1, len(calls))
+
+    def test_field_hook_only_touches_declared_paths(self):
+        seen = []
+        def hook(value):
+            seen.append(value)
+            return value / 100
+        record = {"id": 1, "total": 500, "lines": [{"amount": 250}, {"amount": 250}, {}]}
+        result = transform(record, self.schema,
+                           record_hook=FieldHook(hook, ["total", "lines[].amount", "missing"]))
+        self.assertEqual({"id": 1, "total": 5.0, "lines": [{"amount": 2.5}, {"amount": 2.5}, {}]},
+                         result)
+        self.assertEqual([500, 250, 250], seen)
+
+    def test_field_hook_nested_arrays(self):
+        hook = FieldHook(str.upper, ["a[][]"])
+        self.assertEqual({"a": [["X"], ["Y", "Z"]]}, hook({"a": [["x"], ["y", "z"]]}))
+
+    def test_batch_hook_in_columnar_transform(self):
+        def batch_hook(records):
+            return [r for r in records if r["id"] != "skip"]
+        trans = Transformer(batch_hook=batch_hook)
+        self.assertEqual([{"id": 1}], trans.transform_columnar([{"id": "1"}, {"id": "skip"}],
+                                                               self.schema))
+
+    def test_hooks_in_transform_pool(self):
+        trans = Transformer(record_hook=FieldHook(_cents_to_dollars, ["total"]))
+        with TransformPool(trans, self.schema, processes=1) as pool:
+            self.assertEqual([{"total": 1.0}], list(pool.transform([{"total": 100}])))
+
+
+class TestTransformFunctionCache(unittest.TestCase):
+    schema = {"type": "object",
+              "properties": {"id": {"type": "integer"},
+                             "name": {"type": "string"}}}
+
+    def test_reuses_transformer_for_same_schema(self):
+        first = _cached_transformer(self.schema, None, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING,
+                                    pre_hook=None, in_place=False, record_hook=None)
+        self.assertEqual({"id": 1}, transform({"id": "1"}, self.schema))
+        second = _cached_transformer(self.schema, None, integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING,
+                                     pre_hook=None, in_place=False, record_hook=None)
+        self.assertIs(first, second)
+        self.assertTrue(first[2].shape_cache)
+
+    def test_reuses_transformer_for_equal_schema(self):
+        mdata = {('properties', 'name'): {'selected': False}}
+        first = _cached_transformer(copy.deepcopy(self.schema), copy.deepcopy(mdata))
+        schema, metadata, transformer = _cached_transformer(copy.deepcopy(self.schema),
+                                                            copy.deepcopy(mdata))
+        self.assertIs(first[2], transformer)
+        self.assertIs(first[0], schema)
+        self.assertIs(first[1], metadata)
+        self.assertEqual(self.schema, schema)
+        self.assertEqual(mdata, metadata)
+        self.assertIsNot(transformer, _cached_transformer(copy.deepcopy(self.schema), None)[2])
+
+    def test_rebuilt_schemas_share_shape_cache(self):
+        schema = {"type": "object", "properties": {"rebuilt": {"type": "integer"}}}
+        for i in range(3):
+            self.assertEqual({"rebuilt": i}, transform({"rebuilt": str(i)}, copy.deepcopy(schema)))
+        transformer = _cached_transformer(schema, None,
+                                          integer_datetime_fmt=NO_INTEGER_DATETIME_PARSING,
+                                          pre_hook=None, in_place=False, record_hook=None)[2]
+        self.assertEqual(2, transformer._shape_hits)
+
+    def test_changes_to_schema_take_effect(self):
+        schema = {"type": "object", "properties": {"n": {"type": "integer"}}}
+        mdata = {('properties', 'n'): {'selected': True}}
+        self.assertEqual({"n": 1}, transform({"n": "1"}, schema, metadata=mdata))
+        schema["properties"]["n"] = {"type": "string"}
+        self.assertEqual({"n": "1"}, transform({"n": "1"}, schema, metadata=mdata))
+        mdata[('properties', 'n')]['selected'] = False
+        self.assertEqual({}, transform({"n": "1"}, schema, metadata=mdata))
+
+    def test_unhashable_hooks(self):
+        class Hook:
+            def __eq__(self, other):
+                return isinstance(other, Hook)
+
+            def __call__(self, data, typ, schema):
+                return data.upper() if typ == "string" else data
+
+        self.assertEqual({"id": 1, "name": "A"},
+                         transform({"id": "1", "name": "a"}, self.schema, pre_hook=Hook()))
+
+    def test_schema_that_contains_itself(self):
+        def tree_schema():
+            node = {"type": "object", "properties": {"id": {"type": "integer"}}}
+            node["properties"]["next"] = node
+            return {"type": "object", "properties": {"head": node}}
+
+        for _ in range(2):
+            self.assertEqual({"head": {"id": 1, "next": {"id": 2}}},
+                             transform({"head": {"id": "1", "next": {"id": "2"}}}, tree_schema()))
+
+    def test_separate_transformers_per_options(self):
+        mdata = {('properties', 'name'): {'selected': False}}
+        self.assertEqual({"id": 1}, transform({"id": "1", "name": "a"}, self.schema,
+                                              metadata=mdata))
+        self.assertEqual({"id": 1, "name": "a"}, transform({"id": "1", "name": "a"}, self.schema))
+        self.assertEqual({"id": 1, "name": "A"},
+                         transform({"id": "1", "name": "a"}, self.schema, pre_hook=_upper_hook))
+
+    def test_errors_do_not_accumulate(self):
+        for _ in range(2):
+            with self.assertRaises(SchemaMismatch) as context:
+                transform({"id": "x"}, self.schema)
+            self.assertEqual(1, str(context.exception).count("\tid: "))
+
+    def test_each_thread_gets_its_own_transformer(self):
+        transformers = []
+        def run():
+            transformers.append(_cached_transformer(self.schema, None)[2])
+        for _ in range(2):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        self.assertIsNot(transformers[0], transformers[1])
+
+
+class TestTransformProfile(unittest.TestCase):
+    schema = {"type": "object",
+              "properties": {"id": {"type": ["null", "integer"]},
+                             "either": {"anyOf": [{"type": "integer"}, {"type": "string"}]},
+                             "items": {"type": "array",
+                                       "items": {"type": "string", "format": "date-time"}}}}
+
+    def setUp(self):
+        set_datetime_cache_size(0)
+
+    def tearDown(self):
+        set_datetime_cache_size(DEFAULT_DATETIME_CACHE_SIZE)
+
+    def test_shape_cache_does_not_skip_paths(self):
+        trans = ProfilingTransformer(shape_cache=True)
+        for _ in range(2):
+            trans.transform({"id": "1"}, self.schema)
+        self.assertEqual(2, trans.profile["id"].calls)
+
+    def test_records_stats_per_path(self):
+        data = {"id": "1", "either": "x",
+                "items": ["2017-01-01", "January 2, 2017"]}
+        with ProfilingTransformer() as trans:
+            self.assertEqual({"id": 1, "either": "x",
+                              "items": ["2017-01-01T00:00:00.000000Z",
+                                        "2017-01-02T00:00:00.000000Z"]},
+                             trans.transform(data, self.schema))
+            trans.transform({"id": None, "either": "1", "items": []}, self.schema)
+
+        self.assertEqual(2, trans.profile[""].calls)
+        self.assertEqual({"integer": 1, "null": 1}, trans.profile["id"].types)
+        self.assertEqual({1: 1, 0: 1}, trans.profile["either"].branches)
+        self.assertEqual(2, trans.profile["items[]"].calls)
+        self.assertEqual({"date-time": 2}, trans.profile["items[]"].types)
+        self.assertEqual(1, trans.profile["items[]"].dateutil_fallbacks)
+        self.assertGreater(trans.profile[""].seconds, 0)
+
+    def test_logs_metrics(self):
+        trans = ProfilingTransformer()
+        trans.transform({"id": 1}, self.schema)
+        with self.assertLogs(level='INFO') as logs:
+            trans.log_profile()
+        points = [singer.metrics.parse(line.replace("INFO:root:", "INFO ")) for line in logs.output]
+        self.assertEqual(["", "id"], [p.tags["path"] for p in points])
+        self.assertEqual({"integer": 1}, points[1].tags["types"])
+        self.assertEqual("transform_duration", points[1].metric)
+
+
+class TestDatetimeCache(unittest.TestCase):
+    def setUp(self):
+        set_datetime_cache_size(16)
+
+    def tearDown(self):
+        set_datetime_cache_size(DEFAULT_DATETIME_CACHE_SIZE)
+
+    def test_repeated_strings_hit_cache(self):
+        schema = {"type": "string", "format": "date-time"}
+        for _ in range(3):
+            self.assertEqual('2017-01-01T00:00:00.000000Z', transform('2017-01-01', schema))
+        info = datetime_cache_info()
+        self.assertEqual(1, info.misses)
+        self.assertEqual(2, info.hits)
+
+    def test_integer_formats_are_cached_separately(self):
+        schema = {"type": "string", "format": "date-time"}
+        self.assertEqual('1970-01-02T00:00:00.000000Z',
+                         transform(86400, schema, UNIX_SECONDS_INTEGER_DATETIME_PARSING))
+        self.assertEqual('1970-01-01T00:01:26.400000Z',
+                         transform(86400, schema, UNIX_MILLISECONDS_INTEGER_DATETIME_PARSING))
+        self.assertEqual('1970-01-01T00:01:26.400000Z',
+                         transform(86400.0, schema, UNIX_MILLISECONDS_INTEGER_DATETIME_PARSING))
+        self.assertEqual(3, datetime_cache_info().misses)
+
+    def test_cache_is_bounded(self):
+        trans = Transformer(UNIX_SECONDS_INTEGER_DATETIME_PARSING)
+        for i in range(100):
+            trans._transform_datetime(i)
+        self.assertEqual(16, datetime_cache_info().currsize)
+
+    def test_unhashable_values_bypass_cache(self):
+        trans = Transformer()
+        self.assertIsNone(trans._transform_datetime({'not': 'a date'}))
+        self.assertEqual(0, datetime_cache_info().currsize)
+
+
 class TestTransformsWithMetadata(unittest.TestCase):
 
     def test_drops_no_data_when_not_dict(self):
@@ -474,6 +1131,84 @@ class TestResolveSchemaReferences(unittest.TestCase):
         self.assertEqual(result['properties']['name']['type'], "string")
         self.assertEqual(result['properties']['name']['still_here'], "yep")
 
+    def test_shared_definitions_are_resolved_once(self):
+        schema = {"type": "object",
+                  "definitions": {"address": {"type": "object",
+                                              "properties": {"zip": {"$ref": "#/definitions/zip"}}},
+                                  "zip": {"type": "string"}},
+                  "properties": {"home": {"$ref": "#/definitions/address"},
+                                 "work": {"$ref": "#/definitions/address"}}}
+        result = resolve_schema_references(schema)
+        self.assertIs(result['properties']['home'], result['properties']['work'])
+        self.assertEqual({"type": "string"}, result['properties']['home']['properties']['zip'])
+        # The definitions themselves are left alone
+        self.assertEqual({"$ref": "#/definitions/zip"},
+                         schema['definitions']['address']['properties']['zip'])
+
+    def test_self_referential_schema(self):
+        schema = {"type": "object",
+                  "properties": {"node": {"$ref": "tree.json#/node"}}}
+        refs = {"tree.json": {"node": {"type": ["null", "object"],
+                                       "properties": {"name": {"type": "string"},
+                                                      "children": {"type": "array",
+                                                                   "items": {"$ref": "#/node"}}}}}}
+        result = resolve_schema_references(schema, refs)
+        node = result['properties']['node']
+        self.assertEqual({"$ref": "tree.json#/node"}, node['properties']['children']['items'])
+        self.assertEqual({"$ref": "#/node"}, refs["tree.json"]["node"]["properties"]["children"]["items"])
+
+        # Values under the recursive reference are passed through
+        data = {"node": {"name": 1, "children": [{"name": 2, "children": []}]}}
+        self.assertEqual({"node": {"name": "1", "children": [{"name": 2, "children": []}]}},
+                         transform(data, result))
+
+    def test_self_referential_schema_can_be_written(self):
+        def tree_schema():
+            return {"type": "object",
+                    "definitions": {"node": {"type": "object",
+                                             "properties": {"next": {"$ref": "#/definitions/node"},
+                                                            "id": {"type": "integer"}}}},
+                    "properties": {"head": {"$ref": "#/definitions/node"}}}
+
+        result = resolve_schema_references(tree_schema())
+        self.assertEqual({"$ref": "#/definitions/node"},
+                         result['properties']['head']['properties']['next'])
+        self.assertEqual(result, json.loads(json.dumps(result)))
+        head = Schema.from_dict(result).properties['head']
+        self.assertEqual('integer', head.properties['id'].type)
+
+        fake_stdout = io.StringIO()
+        original_stdout = sys.stdout
+        sys.stdout = fake_stdout
+        try:
+            messages.write_schema("tree", result, ["id"])
+        finally:
+            sys.stdout = original_stdout
+        self.assertEqual(result, json.loads(fake_stdout.getvalue())["schema"])
+
+        # Rebuilt schemas are equal, so transform() finds the cached one
+        for _ in range(2):
+            self.assertEqual({"head": {"id": 1, "next": {"id": "2"}}},
+                             transform({"head": {"id": "1", "next": {"id": "2"}}},
+                                       resolve_schema_references(tree_schema())))
+
+    def test_resolver_is_reused_for_a_store(self):
+        refs = {"references.json": {"definitions": {"string_type": {"type": "string"}}}}
+        for typ in ("string", "integer"):
+            schema = {"type": "object",
+                      "definitions": {"local": {"type": typ}},
+                      "properties": {"name": {"$ref": "references.json#/definitions/string_type"},
+                                     "local": {"$ref": "#/definitions/local"}}}
+            result = resolve_schema_references(schema, refs)
+            self.assertEqual(typ, result['properties']['local']['type'])
+        self.assertIs(_RESOLVERS[id(refs)][0], refs)
+
+    def test_root_reference(self):
+        schema = {"$ref": "references.json#/definitions/obj"}
+        refs = {"references.json": {"definitions": {"obj": {"type": "object"}}}}
+        self.assertIs(schema, resolve_schema_references(schema, refs))
+        self.assertEqual({"type": "object"}, schema)
+
 class TestPatternProperties(unittest.TestCase):
     def test_pattern_properties_match(self):
         schema = {"type": "object",
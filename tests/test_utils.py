@@ -1,8 +1,22 @@
 import unittest
+import datetime
+import random
 from datetime import datetime as dt
 import pytz
+import dateutil.parser
+import json
 import logging
+import os
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+import singer.metrics as metrics
 import singer.utils as u
+from singer.limiter import SlidingWindow, TokenBucket
+from tests.stub_server import StubServer
 
 
 class TestFormat(unittest.TestCase):
@@ -17,6 +31,66 @@ class TestFormat(unittest.TestCase):
         fdtime = u.strftime(pdtime)
         self.assertEqual(dtime, fdtime)
 
+    def test_strftime_utc_matches_strftime(self):
+        rng = random.Random(0)
+        samples = [dt(1, 1, 1, tzinfo=pytz.UTC),
+                   dt(999, 12, 31, 23, 59, 59, 999999, tzinfo=pytz.UTC),
+                   dt(9999, 12, 31, 23, 59, 59, 999999, tzinfo=datetime.timezone.utc)]
+        for _ in range(1000):
+            samples.append(dt(rng.randint(1, 9999), rng.randint(1, 12), rng.randint(1, 28),
+                              rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+                              rng.randint(0, 999999), tzinfo=pytz.UTC))
+        for sample in samples:
+            expected = sample.strftime(u.DATETIME_FMT)
+            if expected.startswith('4Y'):
+                expected = sample.strftime(u.DATETIME_FMT_SAFE)
+            self.assertEqual(expected, u.strftime_utc(sample))
+            self.assertEqual(expected, u.strftime(sample))
+
+    def test_strftime_requires_utc(self):
+        offset = datetime.timezone(datetime.timedelta(hours=-7))
+        with self.assertRaises(Exception):
+            u.strftime(dt(2017, 1, 1, tzinfo=offset))
+        with self.assertRaises(Exception):
+            u.strftime(dt(2017, 1, 1))
+
+
+class TestParseDatetime(unittest.TestCase):
+    def test_iso_8601_uses_fast_path(self):
+        before = u.PARSE_STATS.copy()
+        self.assertEqual(u.strptime_to_utc("2017-03-18T07:00:05-0700"),
+                         dt(2017, 3, 18, 14, 0, 5, tzinfo=pytz.UTC))
+        self.assertEqual(u.PARSE_STATS['ciso8601'], before['ciso8601'] + 1)
+        self.assertEqual(u.PARSE_STATS['dateutil'], before['dateutil'])
+
+    def test_non_iso_8601_falls_back_to_dateutil(self):
+        before = u.PARSE_STATS.copy()
+        self.assertEqual(u.strptime_to_utc("March 18, 2017 7:00am"),
+                         dt(2017, 3, 18, 7, 0, 0, tzinfo=pytz.UTC))
+        self.assertEqual(u.PARSE_STATS['dateutil'], before['dateutil'] + 1)
+
+    def test_partial_dates_keep_dateutil_behaviour(self):
+        before = u.PARSE_STATS.copy()
+        self.assertEqual(u.strptime_to_utc("2017-01").month, 1)
+        self.assertEqual(u.PARSE_STATS['ciso8601'], before['ciso8601'])
+
+    def test_fast_path_matches_dateutil(self):
+        for value in ["2017-01-01", "2017-01-01T00:00:00Z",
+                      "2017-01-01T10:11:12.123456+05:30",
+                      "2017-01-01 10:11:12", "0090-01-01T00:00:00Z"]:
+            expected = dateutil.parser.parse(value)
+            if expected.tzinfo is None:
+                expected = expected.replace(tzinfo=pytz.UTC)
+            self.assertEqual(u.strptime_to_utc(value), expected)
+
+    def test_forms_dateutil_rejects_skip_fast_path(self):
+        before = u.PARSE_STATS.copy()
+        for value in ["2018-01-01T24:00:00Z", "2018-01-01 24:00",
+                      "2018-W01-1", "2018-001T00:00:00"]:
+            with self.assertRaises(ValueError):
+                u.strptime_to_utc(value)
+        self.assertEqual(u.PARSE_STATS['ciso8601'], before['ciso8601'])
+
 
 class TestHandleException(unittest.TestCase):
     def setUp(self):
@@ -33,3 +107,181 @@ class TestHandleException(unittest.TestCase):
         def foo():
             raise RuntimeError("foo")
         self.assertRaises(RuntimeError, foo)
+
+
+class StubResponse():
+    def __init__(self, status_code, headers):
+        self.status_code = status_code
+        self.headers = dict(headers)
+
+
+class StubHTTPError(Exception):
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            return response.status
+    except urllib.error.HTTPError as exc:
+        raise StubHTTPError(StubResponse(exc.code, exc.headers.items())) from exc
+
+
+class TestAdaptiveBackoff(unittest.TestCase):
+
+    def test_waits_as_long_as_retry_after_asks(self):
+        with StubServer([(429, {'Retry-After': '0.3'})]) as server, \
+             patch('singer.metrics.log') as log:
+            status = u.adaptive_backoff(StubHTTPError)(get)(server.url)
+
+        self.assertEqual(200, status)
+        wait = server.request_times[1] - server.request_times[0]
+        self.assertGreaterEqual(wait, 0.3)
+        self.assertLess(wait, 0.3 * (1 + u.RETRY_AFTER_JITTER) + 0.2)
+
+        points = [args[1] for args, _ in log.call_args_list]
+        self.assertEqual(['http_retry_wait', 'http_retry_count'],
+                         [point.metric for point in points])
+        self.assertEqual({'attempt': 1, 'http_status_code': 429}, points[0].tags)
+        self.assertEqual(1, points[1].value)
+
+    def test_uses_rate_limit_reset_header(self):
+        with StubServer([(503, {'RateLimit-Reset': '0.2'}),
+                         (503, {'RateLimit-Reset': '0.2'})]) as server, \
+             patch('singer.metrics.log'):
+            u.adaptive_backoff(StubHTTPError)(get)(server.url)
+
+        self.assertEqual(3, len(server.request_times))
+        self.assertGreaterEqual(server.request_times[2] - server.request_times[0], 0.4)
+
+    def test_gives_up_on_4xx(self):
+        with StubServer([(404, {})]) as server, patch('singer.metrics.log'):
+            with self.assertRaises(StubHTTPError):
+                u.adaptive_backoff(StubHTTPError)(get)(server.url)
+        self.assertEqual(1, len(server.request_times))
+
+    def test_exponential_backoff_without_headers(self):
+        waits = u.retry_after_expo(factor=2, max_value=5)
+        next(waits)
+        for attempt in range(4):
+            wait = waits.send(StubHTTPError(StubResponse(503, {})))
+            self.assertLessEqual(wait, min(5, 2 * 2 ** attempt))
+
+    def test_429_throttles_limiter(self):
+        limiter = TokenBucket(100, per=1)
+        with StubServer([(429, {'Retry-After': '0.1'})]) as server, \
+             patch('singer.metrics.log'):
+            u.adaptive_backoff(StubHTTPError, limiter=limiter)(limiter(get))(server.url)
+
+        self.assertLess(limiter.rate, 100)
+        self.assertGreater(limiter.rate, 100 * 0.5)
+
+    def test_429_with_sliding_window(self):
+        limiter = SlidingWindow(100, 1)
+        with StubServer([(429, {'Retry-After': '0.1'})]) as server, \
+             patch('singer.metrics.log'):
+            status = u.adaptive_backoff(StubHTTPError, limiter=limiter)(limiter(get))(server.url)
+        self.assertEqual(200, status)
+        self.assertEqual(2, len(server.request_times))
+
+
+class TestBatches(unittest.TestCase):
+
+    def test_by_count_from_generator(self):
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]],
+                         list(u.batches((i for i in range(7)), max_count=3)))
+
+    def test_by_bytes(self):
+        items = [{"id": i} for i in range(6)]
+        for batch in u.batches(items, max_bytes=30):
+            self.assertLessEqual(sum(u.json_size(item) for item in batch), 30)
+        self.assertEqual(items, [item for batch in u.batches(items, max_bytes=30)
+                                 for item in batch])
+
+    def test_oversized_item_gets_own_batch(self):
+        self.assertEqual([["a"], ["b" * 50], ["c"]],
+                         list(u.batches(["a", "b" * 50, "c"], max_bytes=10)))
+
+    def test_count_and_bytes_together(self):
+        self.assertEqual([[1, 1], [1, 1], [100], [1]],
+                         list(u.batches([1, 1, 1, 1, 100, 1], max_count=2, max_bytes=50,
+                                        sizeof=lambda item: item)))
+
+    def test_flushes_partial_batch_while_source_blocks(self):
+        def slow():
+            yield 1
+            yield 2
+            time.sleep(0.3)
+            yield 3
+
+        start = time.monotonic()
+        flushed = []
+        for batch in u.batches(slow(), max_count=10, max_latency=0.1):
+            flushed.append((batch, time.monotonic() - start))
+
+        self.assertEqual([[1, 2], [3]], [batch for batch, _ in flushed])
+        self.assertLess(flushed[0][1], 0.25)
+
+    def test_latency_does_not_split_fast_sources(self):
+        self.assertEqual([list(range(100))],
+                         list(u.batches(range(100), max_latency=5)))
+
+    def test_source_errors_are_raised(self):
+        def failing():
+            yield 1
+            raise RuntimeError("cursor closed")
+
+        with self.assertRaisesRegex(RuntimeError, "cursor closed"):
+            list(u.batches(failing(), max_count=5, max_latency=1))
+
+    def test_requires_a_limit(self):
+        with self.assertRaises(ValueError):
+            next(u.batches([1]))
+
+
+class TestParseArgs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = self.write('config.json', {'api_key': 'abc'})
+        self.state = self.write('state.json', {'bookmarks': {}})
+        self.catalog = self.write('catalog.json', {'streams': [
+            {'tap_stream_id': 'users', 'schema': {'type': 'object', 'selected': True},
+             'metadata': []},
+            {'tap_stream_id': 'orders', 'schema': {'type': 'object'}, 'metadata': []}]})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as fil:
+            json.dump(data, fil)
+        return path
+
+    def parse_args(self, lazy=False):
+        argv = ['tap', '--config', self.config, '--state', self.state, '--catalog', self.catalog]
+        with patch.object(sys, 'argv', argv):
+            return u.parse_args(['api_key'], lazy=lazy)
+
+    def test_loads_files(self):
+        args = self.parse_args()
+        self.assertEqual({'api_key': 'abc'}, args.config)
+        self.assertEqual({'bookmarks': {}}, args.state)
+        self.assertEqual(self.catalog, args.catalog_path)
+        self.assertEqual(['users', 'orders'],
+                         [entry.tap_stream_id for entry in args.catalog.streams])
+
+    def test_lazy_catalog(self):
+        args = self.parse_args(lazy=True)
+        entry = args.catalog.get_stream('users')
+        self.assertIsNotNone(entry._raw_schema)
+        self.assertTrue(entry.is_selected())
+        self.assertEqual('object', entry.schema.type)
+        self.assertEqual(self.parse_args().catalog.to_dict(), args.catalog.to_dict())
+
+    def test_times_each_phase(self):
+        args = self.parse_args()
+        self.assertEqual({'config', 'state', 'catalog'}, set(args.load_timings))